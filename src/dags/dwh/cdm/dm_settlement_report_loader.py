@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 from logging import Logger
 from typing import List
@@ -9,69 +10,71 @@ from lib.crud import PgReader, PgSaver
 from lib.etl_settings_repository import EtlSettingsRepository
 
 
-class RestaurantReportObj(BaseModel):
-    restaurant_id: str
-    restaurant_name: str
-    date: date
-    orders_count: int
-    orders_total_sum: float
-    bonus_payment_sum: float
-    bonus_granted_sum: float
-
-    def __lt__(self, other: 'RestaurantReportObj') -> bool:
-        return self.date < other.date
-
-
 class RestaurantReportSettings(BaseModel, allow_population_by_field_name=True):
     last_loaded_date: date = Field(alias='date', default=date.min)
 
 
 class RestaurantReportsToCdmWorkflow(PgReader, PgSaver):
 
-    def list_reports(self, source: Connection, report_settings: RestaurantReportSettings, offset: int, limit: int) -> List[RestaurantReportObj]:
-        reports = super().list(
+    def list_periods(self, source: Connection, report_settings: RestaurantReportSettings) -> List[RestaurantReportSettings]:
+        periods = super().list(
             conn=source,
-            model=RestaurantReportObj,
+            model=RestaurantReportSettings,
             query="""
-                SELECT
-                    dr.restaurant_id,
-                    dr.restaurant_name,
-                    dt.date,
-                    COUNT(DISTINCT "do".id) AS orders_count,
-                    SUM(fps.total_sum) AS orders_total_sum,
-                    SUM(fps.bonus_payment) AS bonus_payment_sum,
-                    SUM(fps.bonus_grant) AS bonus_granted_sum
-                FROM 
-                    dds.fct_product_sales fps
-                INNER JOIN
-                    dds.dm_orders "do" ON "do".id = fps.order_id
-                INNER JOIN
-                    dds.dm_timestamps dt ON dt.id = "do".timestamp_id
-                INNER JOIN
-                    dds.dm_restaurants dr ON dr.id = "do".restaurant_id
+                SELECT DISTINCT
+                    dt.date
+                FROM
+                    dds.dm_timestamps dt
                 WHERE
-                    "do".order_status = 'CLOSED' AND dt.date >= %(date_threshold)s
-                GROUP BY
-                    dt.date, dr.restaurant_id, dr.restaurant_name
+                    dt.date >= %(date_threshold)s
                 ORDER BY
-                    dt.date
-                OFFSET
-                    %(offset)s
-                LIMIT
-                    %(limit)s;
+                    dt.date;
             """,
             params={
-                'date_threshold': report_settings.last_loaded_date,
-                'offset': offset,
-                'limit': limit
+                'date_threshold': report_settings.last_loaded_date
             }
         )
-        return reports
+        return periods
 
-    def insert_report(self, target: Connection, report: RestaurantReportObj) -> None:
+    def upsert_reports(self, target: Connection, period: RestaurantReportSettings) -> None:
         super().insert(
             conn=target,
+            # Строим и сохраняем отчет за одну дату на стороне сервера.
             query="""
+                WITH order_sales AS (
+                    SELECT
+                        "do".restaurant_id,
+                        dt.date,
+                        SUM(fps.total_sum) AS total_sum,
+                        SUM(fps.bonus_payment) AS bonus_payment,
+                        SUM(fps.bonus_grant) AS bonus_grant
+                    FROM
+                        dds.fct_product_sales fps
+                    INNER JOIN
+                        dds.dm_orders "do" ON "do".id = fps.order_id
+                    INNER JOIN
+                        dds.dm_timestamps dt ON dt.id = "do".timestamp_id
+                    WHERE
+                        "do".order_status = 'CLOSED' AND dt.date = %(date)s
+                    GROUP BY
+                        fps.order_id, "do".restaurant_id, dt.date
+                ),
+                reports AS (
+                    SELECT
+                        dr.restaurant_id,
+                        (ARRAY_AGG(dr.restaurant_name ORDER BY dr.active_from DESC))[1] AS restaurant_name,
+                        os.date,
+                        COUNT(*) AS orders_count,
+                        SUM(os.total_sum) AS orders_total_sum,
+                        SUM(os.bonus_payment) AS bonus_payment_sum,
+                        SUM(os.bonus_grant) AS bonus_granted_sum
+                    FROM
+                        order_sales os
+                    INNER JOIN
+                        dds.dm_restaurants dr ON dr.id = os.restaurant_id
+                    GROUP BY
+                        os.date, dr.restaurant_id
+                )
                 INSERT INTO
                     cdm.dm_settlement_report(
                         restaurant_id,
@@ -83,16 +86,18 @@ class RestaurantReportsToCdmWorkflow(PgReader, PgSaver):
                         orders_bonus_granted_sum,
                         order_processing_fee,
                         restaurant_reward_sum)
-                VALUES
-                    (%(restaurant_id)s,
-                    %(restaurant_name)s,
-                    %(settlement_date)s,
-                    %(orders_count)s,
-                    %(orders_total_sum)s,
-                    %(orders_bonus_payment_sum)s,
-                    %(orders_bonus_granted_sum)s,
-                    %(order_processing_fee)s,
-                    %(restaurant_reward_sum)s)
+                SELECT
+                    restaurant_id,
+                    restaurant_name,
+                    date,
+                    orders_count,
+                    orders_total_sum,
+                    bonus_payment_sum,
+                    bonus_granted_sum,
+                    orders_total_sum * 0.25,
+                    orders_total_sum - orders_total_sum * 0.25 - bonus_payment_sum
+                FROM
+                    reports
                 ON CONFLICT
                     (settlement_date, restaurant_id)
                 DO UPDATE SET
@@ -102,66 +107,69 @@ class RestaurantReportsToCdmWorkflow(PgReader, PgSaver):
                     orders_bonus_granted_sum = EXCLUDED.orders_bonus_granted_sum,
                     order_processing_fee = EXCLUDED.order_processing_fee,
                     restaurant_reward_sum = EXCLUDED.restaurant_reward_sum
+                WHERE
+                    (dm_settlement_report.orders_count,
+                    dm_settlement_report.orders_total_sum,
+                    dm_settlement_report.orders_bonus_payment_sum,
+                    dm_settlement_report.orders_bonus_granted_sum,
+                    dm_settlement_report.order_processing_fee,
+                    dm_settlement_report.restaurant_reward_sum)
+                    IS DISTINCT FROM
+                    (EXCLUDED.orders_count,
+                    EXCLUDED.orders_total_sum,
+                    EXCLUDED.orders_bonus_payment_sum,
+                    EXCLUDED.orders_bonus_granted_sum,
+                    EXCLUDED.order_processing_fee,
+                    EXCLUDED.restaurant_reward_sum)
             """,
             params={
-                'restaurant_id': report.restaurant_id, 
-                'restaurant_name': report.restaurant_name,
-                'settlement_date': report.date,
-                'orders_count': report.orders_count,
-                'orders_total_sum': report.orders_total_sum,
-                'orders_bonus_payment_sum': report.bonus_payment_sum,
-                'orders_bonus_granted_sum': report.bonus_granted_sum,
-                'order_processing_fee': report.orders_total_sum * 0.25,
-                'restaurant_reward_sum': report.orders_total_sum - report.orders_total_sum * 0.25 - report.bonus_payment_sum
-            }
+                'date': period.last_loaded_date
+            },
+            prepare=True
         )
 
 
 class SettlementReportLoader:
     WF_KEY = 'settlement_report_dds_to_cdm_workflow'
-    BATCH_LIMIT = 100
+    MAX_WORKERS = 4
 
-    def __init__(self, pg_origin: PgConnect, pg_dest: PgConnect, log: Logger) -> None:
-        self.pg_origin = pg_origin
+    def __init__(self, pg_dest: PgConnect, log: Logger) -> None:
         self.pg_dest = pg_dest
         self.workflow = RestaurantReportsToCdmWorkflow()
         self.settings_repository = EtlSettingsRepository(schema='cdm')
         self.log = log
 
+    def upsert_period(self, period: RestaurantReportSettings) -> None:
+        # Каждый период пересчитывается в собственном соединении из пула.
+        # Фиксация не ждет сброса WAL: витрина пересчитывается из dds, а синхронная запись контрольной точки
+        # в конце загрузки сбрасывает на диск и все предшествующие ей записи.
+        with self.pg_dest.connection(synchronous_commit=False) as target:
+            self.workflow.upsert_reports(target, period)
+
     def run(self):
-        # Открываем соединения.
-        with self.pg_origin.connection() as source, self.pg_dest.connection() as target:
+        # Открываем соединение: витрина строится из dds-слоя той же базы dwh.
+        with self.pg_dest.connection() as target:
 
             # Прочитываем состояние загрузки.
             wf_setting = self.settings_repository.get_setting(target, self.WF_KEY)
             report_settings = RestaurantReportSettings(**wf_setting.workflow_settings)
             self.log.info(f'Starting to load settlement report from last checkpoint: {report_settings}')
 
-            # Запускаем цикл до полной выгрузки.
-            offset = 0
-            last_loaded_report = None
-            while True:
-
-                # Вычитываем очередную пачку объектов.
-                load_queue = self.workflow.list_reports(source, report_settings, offset, self.BATCH_LIMIT)
-                self.log.info(f'Found {len(load_queue)} restaurant reports to load.')
-
-                # Если нет объектов, выходим из цикла.
-                if not load_queue:
-                    self.log.info('Quitting.')
-                    break
-
-                # Сохраняем объекты в базу dwh.
-                for report in load_queue:
-                    self.workflow.insert_report(target, report)
-
-                # Сдвигаем параметр смещения offset.
-                offset += len(load_queue)
-                last_loaded_report = max(load_queue)
-                self.log.info(f'Processed {offset} rows while syncing restaurant reports.')
-
-            # Сохраняем прогресс в базу dwh.
-            if last_loaded_report:
-                report_settings = RestaurantReportSettings(**last_loaded_report.dict())
-                self.settings_repository.save_setting(target, wf_setting.workflow_key, report_settings)
-                self.log.info(f'Load finished on {report_settings}')
+            # Вычитываем даты, отчеты за которые нужно пересчитать.
+            periods = self.workflow.list_periods(target, report_settings)
+            self.log.info(f'Found {len(periods)} dates to load.')
+
+        # Если нет объектов, выходим из процесса.
+        if not periods:
+            self.log.info('Quitting.')
+            return
+
+        # Пересчитываем отчеты за разные даты параллельно: они не пересекаются по ключу витрины.
+        with ThreadPoolExecutor(max_workers=self.MAX_WORKERS) as executor:
+            list(executor.map(self.upsert_period, periods))
+
+        # Сохраняем прогресс в базу dwh.
+        with self.pg_dest.connection() as target:
+            report_settings = RestaurantReportSettings(**periods[-1].dict())
+            self.settings_repository.save_setting(target, wf_setting.workflow_key, report_settings)
+            self.log.info(f'Load finished on {report_settings}')
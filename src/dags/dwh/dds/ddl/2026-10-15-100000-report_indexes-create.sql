@@ -0,0 +1,4 @@
+CREATE INDEX IF NOT EXISTS fct_deliveries_order_id_index ON dds.fct_deliveries(order_id);
+CREATE INDEX IF NOT EXISTS fct_product_sales_order_id_index ON dds.fct_product_sales(order_id);
+CREATE INDEX IF NOT EXISTS dm_timestamps_year_month_covering_index ON dds.dm_timestamps("year", "month") INCLUDE (id, "date");
+CREATE INDEX IF NOT EXISTS dm_timestamps_date_covering_index ON dds.dm_timestamps("date") INCLUDE (id);
@@ -0,0 +1 @@
+CREATE INDEX IF NOT EXISTS dm_orders_closed_timestamp_id_restaurant_id_index ON dds.dm_orders(timestamp_id, restaurant_id) WHERE order_status = 'CLOSED';
@@ -5,6 +5,7 @@ from psycopg import Connection
 from pydantic import BaseModel, Field
 from lib.connect import PgConnect
 from lib.crud import PgReader, PgSaver
+from lib.etl_config import EtlConfig
 from lib.etl_settings_repository import EtlSettingsRepository
 
 
@@ -13,9 +14,6 @@ class CourierObj(BaseModel):
     object_id: str
     name: str
 
-    def __lt__(self, other: 'CourierObj'):
-        return self.id < other.id
-
 
 class CourierSettings(BaseModel, allow_population_by_field_name=True):
     last_loaded_id: int = Field(alias='id', default=-1)
@@ -46,23 +44,22 @@ class CouriersToStgWorkflow(PgReader, PgSaver):
         )
         return couriers
 
-    def insert_courier(self, target: Connection, courier: CourierObj) -> None:
-        super().insert(
+    def insert_couriers(self, target: Connection, couriers: List[CourierObj]) -> None:
+        super().insert_many(
             conn=target,
             query="""
                 INSERT INTO
                     dds.dm_couriers(courier_id, courier_name)
                 VALUES
-                    (%(courier_id)s, %(courier_name)s)
+                    (%s, %s)
                 ON CONFLICT
                     (courier_id)
                 DO UPDATE SET
                     courier_name = EXCLUDED.courier_name
+                WHERE
+                    dm_couriers.courier_name IS DISTINCT FROM EXCLUDED.courier_name
             """,
-            params={
-                'courier_id': courier.object_id,
-                'courier_name': courier.name
-            }
+            params_seq=[(courier.object_id, courier.name) for courier in couriers]
         )
 
 
@@ -75,6 +72,7 @@ class CouriersLoader:
         self.pg_dest = pg_dest
         self.workflow = CouriersToStgWorkflow()
         self.settings_repository = EtlSettingsRepository(schema='dds')
+        self.batch_limit = EtlConfig.load().batch_limit(self.WF_KEY, self.BATCH_LIMIT)
         self.log = log
 
     def run(self):
@@ -87,7 +85,7 @@ class CouriersLoader:
             self.log.info(f'Starting to load couriers from last checkpoint: {courier_settings}')
 
             # Вычитываем очередную пачку объектов.
-            load_queue = self.workflow.list_couriers(source, courier_settings, self.BATCH_LIMIT)
+            load_queue = self.workflow.list_couriers(source, courier_settings, self.batch_limit)
             self.log.info(f'Found {len(load_queue)} couriers to load.')
 
             # Если нет объектов, выходим из процесса.
@@ -95,12 +93,11 @@ class CouriersLoader:
                 self.log.info('Quitting.')
                 return
 
-            # Сохраняем объекты в базу dwh.
-            for courier in load_queue:
-                self.workflow.insert_courier(target, courier)
+            # Сохраняем объекты в базу dwh одним пакетом.
+            self.workflow.insert_couriers(target, load_queue)
 
-            # Сохраняем прогресс в базу dwh.
-            last_loaded_courier = max(load_queue)
+            # Сохраняем прогресс в базу dwh: выборка упорядочена, последний объект и есть максимальный.
+            last_loaded_courier = load_queue[-1]
             courier_settings = CourierSettings(**last_loaded_courier.dict())
             self.settings_repository.save_setting(target, wf_setting.workflow_key, courier_settings)
             self.log.info(f'Load finished on {courier_settings}')
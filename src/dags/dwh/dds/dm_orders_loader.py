@@ -1,13 +1,14 @@
 from datetime import datetime
 from logging import Logger
-from typing import List, Optional
+from typing import Iterator, List, Optional
 
-from bson.objectid import ObjectId
 from psycopg import Connection
 from pydantic import BaseModel, Field
 from lib.connect import PgConnect
 from lib.crud import PgReader, PgSaver
+from lib.etl_config import EtlConfig
 from lib.etl_settings_repository import EtlSettingsRepository
+from lib.utils import ACTIVE_TO_INF, chunked
 
 
 class OrderObj(BaseModel):
@@ -18,78 +19,107 @@ class OrderObj(BaseModel):
     restaurant_fk: Optional[int]
     timestamp_fk: Optional[int]
 
-    def __lt__(self, other: 'OrderObj'):
-        return (self.update_ts, self.object_id) < (other.update_ts, other.object_id)
-
 
 class OrderSettings(BaseModel, allow_population_by_field_name=True):
     last_loaded_ts: datetime = Field(alias='update_ts', default=datetime.min)
-    last_loaded_oid: str = Field(alias='object_id', default=str(ObjectId('0' * 24)))
+    last_loaded_oid: str = Field(alias='object_id', default='000000000000000000000000')
 
 
 class OrdersToDdsWorkflow(PgReader, PgSaver):
 
-    def list_orders(self, source: Connection, order_settings: OrderSettings, limit: int) -> List[OrderObj]:
-        orders = super().list(
+    def list_orders(self, source: Connection, order_settings: OrderSettings, limit: int) -> Iterator[OrderObj]:
+        orders = super().stream(
             conn=source,
             model=OrderObj,
-            # Совмещаем данные заказов из stg-слоя и связанных сущностей dds-слоя, для получения внешних ключей
+            # Совмещаем данные заказов из stg-слоя и связанных сущностей dds-слоя, для получения внешних ключей.
+            # Каждое соединение находит не более одной строки: у ресторана берем только актуальную версию.
+            # В упорядоченной по дате выборке, оставляем данные до первого отсутствия внешнего ключа какой либо сущности.
             query="""
                 SELECT
-                    oo.object_id,
-                    oo.update_ts,
-                    "order".final_status,
-                    MAX(du.id) AS user_fk,
-                    MAX(dr.id) AS restaurant_fk,
-                    MAX(dt.id) AS timestamp_fk
-                FROM
-                    stg.ordersystem_orders oo
-                CROSS JOIN
-                    json_to_record(oo.object_value::JSON) AS "order"(
-                        final_status VARCHAR,
-                        "user" JSON,
-                        restaurant JSON,
-                        "date" TIMESTAMP
-                    )
-                LEFT JOIN
-                    dds.dm_users du ON du.user_id = "order".user ->> 'id'
-                LEFT JOIN
-                    dds.dm_restaurants dr ON dr.restaurant_id = "order".restaurant ->> 'id'
-                LEFT JOIN
-                    dds.dm_timestamps dt ON dt.ts = "order".date
+                    object_id,
+                    update_ts,
+                    final_status,
+                    user_fk,
+                    restaurant_fk,
+                    timestamp_fk
+                FROM (
+                    SELECT
+                        oo.object_id,
+                        oo.update_ts,
+                        oo.final_status,
+                        du.id AS user_fk,
+                        dr.id AS restaurant_fk,
+                        dt.id AS timestamp_fk,
+                        BOOL_AND(du.id IS NOT NULL AND dr.id IS NOT NULL AND dt.id IS NOT NULL)
+                            OVER (ORDER BY oo.update_ts, oo.object_id) AS is_complete
+                    FROM
+                        stg.ordersystem_orders oo
+                    LEFT JOIN
+                        dds.dm_users du ON du.user_id = oo.user_external_id
+                    LEFT JOIN
+                        dds.dm_restaurants dr ON dr.restaurant_id = oo.restaurant_external_id AND dr.active_to = %(active_to)s
+                    LEFT JOIN
+                        dds.dm_timestamps dt ON dt.ts = oo.order_date::TIMESTAMP
+                    WHERE
+                        (oo.update_ts, oo.object_id) > (%(ts_threshold)s, %(oid_threshold)s)
+                    ORDER BY
+                        oo.update_ts, oo.object_id
+                    LIMIT
+                        %(limit)s
+                ) orders
                 WHERE
-                    oo.update_ts > %(ts_threshold)s OR
-                    (oo.update_ts = %(ts_threshold)s AND oo.object_id > %(oid_threshold)s)
-                GROUP BY
-                    oo.update_ts, oo.object_id, "order".final_status
+                    is_complete
                 ORDER BY
-                    oo.update_ts, oo.object_id
-                LIMIT
-                    %(limit)s;
+                    update_ts, object_id;
             """,
             params={
                 'ts_threshold': order_settings.last_loaded_ts,
                 'oid_threshold': order_settings.last_loaded_oid,
+                'active_to': ACTIVE_TO_INF,
                 'limit': limit
             }
         )
-
-        # В упорядоченной по дате выборке, оставляем данные до первого отсутствия внешнего ключа какой либо сущности.
-        for idx, order in enumerate(orders):
-            if not all([order.user_fk, order.restaurant_fk, order.timestamp_fk]):
-                orders = orders[:idx]
-                break
-
         return orders
 
-    def insert_order(self, target: Connection, order: OrderObj) -> None:
+    def insert_orders(self, target: Connection, orders: List[OrderObj]) -> None:
+        # Загружаем пачку заказов во временную таблицу через COPY.
+        super().copy(
+            conn=target,
+            staging="""
+                CREATE TEMP TABLE IF NOT EXISTS dm_orders_stg(
+                    order_key VARCHAR,
+                    order_status VARCHAR,
+                    user_id INT,
+                    restaurant_id INT,
+                    timestamp_id INT
+                )
+                ON COMMIT DELETE ROWS;
+            """,
+            query="""
+                COPY dm_orders_stg(order_key, order_status, user_id, restaurant_id, timestamp_id) FROM STDIN
+            """,
+            rows=(
+                (order.object_id, order.final_status, order.user_fk, order.restaurant_fk, order.timestamp_fk)
+                for order in orders
+            )
+        )
+
+        # Переносим пачку в dds-слой, одновременно очищая временную таблицу для следующей пачки.
         super().insert(
             conn=target,
             query="""
+                WITH staged AS (
+                    DELETE FROM
+                        dm_orders_stg
+                    RETURNING
+                        order_key, order_status, user_id, restaurant_id, timestamp_id
+                )
                 INSERT INTO
                     dds.dm_orders(order_key, order_status, user_id, restaurant_id, timestamp_id)
-                VALUES
-                    (%(order_key)s, %(order_status)s, %(user_id)s, %(restaurant_id)s, %(timestamp_id)s)
+                SELECT
+                    order_key, order_status, user_id, restaurant_id, timestamp_id
+                FROM
+                    staged
                 ON CONFLICT
                     (order_key)
                 DO UPDATE SET
@@ -97,26 +127,35 @@ class OrdersToDdsWorkflow(PgReader, PgSaver):
                     user_id = EXCLUDED.user_id,
                     restaurant_id = EXCLUDED.restaurant_id,
                     timestamp_id = EXCLUDED.timestamp_id
+                WHERE
+                    (dm_orders.order_status,
+                    dm_orders.user_id,
+                    dm_orders.restaurant_id,
+                    dm_orders.timestamp_id)
+                    IS DISTINCT FROM
+                    (EXCLUDED.order_status,
+                    EXCLUDED.user_id,
+                    EXCLUDED.restaurant_id,
+                    EXCLUDED.timestamp_id)
             """,
-            params={
-                'order_key': order.object_id, 
-                'order_status': order.final_status,
-                'user_id': order.user_fk,
-                'restaurant_id': order.restaurant_fk,
-                'timestamp_id': order.timestamp_fk
-            }
+            params=None,
+            prepare=True
         )
 
 
 class OrdersLoader:
     WF_KEY = 'orders_stg_to_dds_workflow'
     BATCH_LIMIT = 5000
+    FLUSH_SIZE = 500
 
     def __init__(self, pg_origin: PgConnect, pg_dest: PgConnect, log: Logger) -> None:
         self.pg_origin = pg_origin
         self.pg_dest = pg_dest
         self.workflow = OrdersToDdsWorkflow()
         self.settings_repository = EtlSettingsRepository(schema='dds')
+        etl_config = EtlConfig.load()
+        self.batch_limit = etl_config.batch_limit(self.WF_KEY, self.BATCH_LIMIT)
+        self.flush_size = etl_config.flush_size(self.WF_KEY, self.FLUSH_SIZE)
         self.log = log
 
     def run(self):
@@ -128,21 +167,21 @@ class OrdersLoader:
             order_settings = OrderSettings(**wf_setting.workflow_settings)
             self.log.info(f'Starting to load orders from last checkpoint: {order_settings}')
 
-            # Вычитываем очередную пачку объектов.
-            load_queue = self.workflow.list_orders(source, order_settings, self.BATCH_LIMIT)
-            self.log.info(f'Found {len(load_queue)} orders to load.')
+            # Вычитываем объекты потоком и сохраняем их в базу dwh пачками.
+            processed = 0
+            last_loaded_order = None
+            for load_queue in chunked(self.workflow.list_orders(source, order_settings, self.batch_limit), self.flush_size):
+                self.workflow.insert_orders(target, load_queue)
+                processed += len(load_queue)
+                last_loaded_order = load_queue[-1]
+            self.log.info(f'Loaded {processed} orders.')
 
             # Если нет объектов, выходим из процесса.
-            if not load_queue:
+            if not last_loaded_order:
                 self.log.info('Quitting.')
                 return
 
-            # Сохраняем объекты в базу dwh.
-            for order in load_queue:
-                self.workflow.insert_order(target, order)
-
             # Сохраняем прогресс в базу dwh.
-            last_loaded_order = max(load_queue)
             order_settings = OrderSettings(**last_loaded_order.dict())
             self.settings_repository.save_setting(target, wf_setting.workflow_key, order_settings)
             self.log.info(f'Load finished on {order_settings.last_loaded_ts}')
@@ -1,115 +1,156 @@
 from datetime import datetime
 from logging import Logger
-from typing import List
+from typing import Optional
 
-from bson.objectid import ObjectId
 from psycopg import Connection
 from pydantic import BaseModel, Field
 from lib.connect import PgConnect
 from lib.crud import PgReader, PgSaver
+from lib.etl_config import EtlConfig
 from lib.etl_settings_repository import EtlSettingsRepository
-
-
-class ProductObj(BaseModel):
-    product_id: str = Field(alias='_id')
-    restaurant_id: str
-    name: str
-    price: float
-    update_ts: datetime
-    restaurant_fk: int
-
-    def __lt__(self, other: 'ProductObj') -> bool:
-        return (self.update_ts, self.restaurant_id, self.product_id) < (other.update_ts, other.restaurant_id, other.product_id)
+from lib.utils import ACTIVE_TO_INF
 
 
 class ProductSettings(BaseModel, allow_population_by_field_name=True):
     last_loaded_ts: datetime = Field(alias='update_ts', default=datetime.min)
-    last_loaded_restaurant_id: str = Field(alias='restaurant_id', default=str(ObjectId('0' * 24)))
-    last_loaded_product_id: str = Field(alias='product_id', default=str(ObjectId('0' * 24)))
+    last_loaded_restaurant_id: str = Field(alias='restaurant_id', default='000000000000000000000000')
+    last_loaded_product_id: str = Field(alias='product_id', default='000000000000000000000000')
 
 
 class ProductsToDdsWorkflow(PgReader, PgSaver):
 
-    def list_products(self, source: Connection, product_settings: ProductSettings, limit: int) -> List[ProductObj]:
-        products = super().list(
-            conn=source,
-            model=ProductObj,
-            # Совмещаем данные продуктов из stg-слоя и ресторанов dds-слоя, для получения внешних ключей
+    def load_products(self, target: Connection, product_settings: ProductSettings, limit: int) -> Optional[ProductSettings]:
+        # Создаем (если нужно) временную таблицу для пачки продуктов.
+        super().insert(
+            conn=target,
             query="""
+                CREATE TEMP TABLE IF NOT EXISTS dm_products_stg(
+                    product_id VARCHAR,
+                    product_name VARCHAR,
+                    product_price NUMERIC(14, 2),
+                    restaurant_id INT,
+                    active_from TIMESTAMP
+                )
+                ON COMMIT DELETE ROWS;
+            """,
+            params=None
+        )
+
+        # Переносим пачку продуктов из stg-слоя во временную таблицу на стороне сервера и возвращаем ключ её последней строки.
+        last_loaded = super().retrieve(
+            conn=target,
+            model=ProductSettings,
+            # Совмещаем данные продуктов из stg-слоя и ресторанов dds-слоя, для получения внешних ключей.
+            # У ресторана берем только актуальную версию, поэтому соединение находит не более одной строки.
+            query="""
+                WITH batch AS (
+                    SELECT
+                        dr.restaurant_id,
+                        product._id AS product_id,
+                        product.name,
+                        product.price,
+                        "or".update_ts,
+                        dr.id AS restaurant_fk
+                    FROM
+                        stg.ordersystem_restaurants "or"
+                    CROSS JOIN
+                        jsonb_to_recordset("or".object_value_jsonb -> 'menu') AS product(
+                            _id VARCHAR,
+                            name VARCHAR,
+                            price NUMERIC(14, 2)
+                        )
+                    INNER JOIN
+                        dds.dm_restaurants dr ON dr.restaurant_id = "or".object_id AND dr.active_to = %(active_to)s
+                    WHERE
+                        ("or".update_ts, dr.restaurant_id, product._id) >
+                        (%(ts_threshold)s, %(restaurant_id_threshold)s, %(product_id_threshold)s)
+                    ORDER BY
+                        "or".update_ts, dr.restaurant_id, product._id
+                    LIMIT
+                        %(limit)s
+                ),
+                staged AS (
+                    INSERT INTO
+                        dm_products_stg(product_id, product_name, product_price, restaurant_id, active_from)
+                    SELECT
+                        product_id, name, price, restaurant_fk, update_ts
+                    FROM
+                        batch
+                )
                 SELECT
-                    dr.restaurant_id,
-                    product._id,
-                    product.name,
-                    product.price,
-                    "or".update_ts,
-                    MAX(dr.id) AS restaurant_fk
+                    update_ts,
+                    restaurant_id,
+                    product_id
                 FROM
-                    stg.ordersystem_restaurants "or"
-                CROSS JOIN
-                    json_to_recordset("or".object_value::JSON -> 'menu') AS product(
-                        _id VARCHAR,
-                        name VARCHAR,
-                        price NUMERIC(14, 2)
-                    )
-                INNER JOIN
-                    dds.dm_restaurants dr ON dr.restaurant_id = "or".object_id
-                WHERE
-                    "or".update_ts > %(ts_threshold)s OR
-                    ("or".update_ts = %(ts_threshold)s AND
-                        (dr.restaurant_id > %(restaurant_id_threshold)s OR
-                            (dr.restaurant_id = %(restaurant_id_threshold)s AND product._id > %(product_id_threshold)s)))
-                GROUP BY
-                    "or".update_ts, dr.restaurant_id, product._id, product.name, product.price
+                    batch
                 ORDER BY
-                    "or".update_ts, dr.restaurant_id, product._id
+                    update_ts DESC, restaurant_id DESC, product_id DESC
                 LIMIT
-                    %(limit)s;
+                    1;
             """,
             params={
                 'ts_threshold': product_settings.last_loaded_ts,
                 'restaurant_id_threshold': product_settings.last_loaded_restaurant_id,
                 'product_id_threshold': product_settings.last_loaded_product_id,
+                'active_to': ACTIVE_TO_INF,
                 'limit': limit
             }
         )
-        return products
 
-    def insert_product(self, target: Connection, product: ProductObj) -> None:
+        # Если пачка пуста, в dds-слое нечего обновлять.
+        if not last_loaded:
+            return None
+
+        # Закрываем актуальные записи продуктов, данные которых реально изменились.
         super().insert(
             conn=target,
-            # При вставке продукта, обновляем (если есть) последнюю запись продукта, в случае реально новых данных.
             query="""
-                WITH update_product_active_to AS (
-                    UPDATE 
-                        dds.dm_products p
-                    SET
-                        active_to = %(active_from)s
-                    FROM
-                        (SELECT MAX(id) AS id FROM dds.dm_products WHERE product_id = %(product_id)s) latest
-                    WHERE
-                        p.id = latest.id AND
-                        (p.product_name != %(product_name)s OR
-                        p.product_price != %(product_price)s OR
-                        p.restaurant_id != %(restaurant_id)s)
+                UPDATE
+                    dds.dm_products p
+                SET
+                    active_to = s.active_from
+                FROM
+                    dm_products_stg s
+                WHERE
+                    p.product_id = s.product_id AND
+                    p.active_to = %(active_to)s AND
+                    (p.product_name, p.product_price, p.restaurant_id)
+                        IS DISTINCT FROM (s.product_name, s.product_price, s.restaurant_id)
+            """,
+            params={
+                'active_to': ACTIVE_TO_INF
+            },
+            prepare=True
+        )
+
+        # Добавляем новые актуальные записи, одновременно очищая временную таблицу.
+        super().insert(
+            conn=target,
+            query="""
+                WITH staged AS (
+                    DELETE FROM
+                        dm_products_stg
+                    RETURNING
+                        product_id, product_name, product_price, restaurant_id, active_from
                 )
                 INSERT INTO
                     dds.dm_products(product_id, product_name, product_price, restaurant_id, active_from, active_to)
-                VALUES
-                    (%(product_id)s, %(product_name)s, %(product_price)s, %(restaurant_id)s, %(active_from)s, %(active_to)s)
+                SELECT
+                    product_id, product_name, product_price, restaurant_id, active_from, %(active_to)s
+                FROM
+                    staged
                 ON CONFLICT
                     (product_id, active_to)
                 DO NOTHING
             """,
             params={
-                'product_id': product.product_id, 
-                'product_name': product.name,
-                'product_price': product.price,
-                'restaurant_id': product.restaurant_fk,
-                'active_from': product.update_ts,
-                'active_to': datetime(2099, 12, 31),
-            }
+                'active_to': ACTIVE_TO_INF
+            },
+            prepare=True
         )
 
+        return last_loaded
+
 
 class ProductsLoader:
     WF_KEY = 'products_stg_to_dds_workflow'
@@ -120,32 +161,26 @@ class ProductsLoader:
         self.pg_dest = pg_dest
         self.workflow = ProductsToDdsWorkflow()
         self.settings_repository = EtlSettingsRepository(schema='dds')
+        self.batch_limit = EtlConfig.load().batch_limit(self.WF_KEY, self.BATCH_LIMIT)
         self.log = log
 
     def run(self):
-        # Открываем соединения.
-        with self.pg_origin.connection() as source, self.pg_dest.connection() as target:
+        # Открываем соединение: stg- и dds-слои лежат в одной базе dwh, поэтому пачка переносится на стороне сервера.
+        with self.pg_dest.connection() as target:
 
             # Прочитываем состояние загрузки.
             wf_setting = self.settings_repository.get_setting(target, self.WF_KEY)
             product_settings = ProductSettings(**wf_setting.workflow_settings)
             self.log.info(f'Starting to load products from last checkpoint: {product_settings}')
 
-            # Вычитываем очередную пачку объектов.
-            load_queue = self.workflow.list_products(source, product_settings, self.BATCH_LIMIT)
-            self.log.info(f'Found {len(load_queue)} products to load.')
+            # Переносим очередную пачку объектов в dds-слой.
+            last_loaded = self.workflow.load_products(target, product_settings, self.batch_limit)
 
             # Если нет объектов, выходим из процесса.
-            if not load_queue:
+            if not last_loaded:
                 self.log.info('Quitting.')
                 return
 
-            # Сохраняем объекты в базу dwh.
-            for product in load_queue:
-                self.workflow.insert_product(target, product)
-
             # Сохраняем прогресс в базу dwh.
-            last_loaded_product = max(load_queue)
-            product_settings = ProductSettings(**last_loaded_product.dict())
-            self.settings_repository.save_setting(target, wf_setting.workflow_key, product_settings)
-            self.log.info(f'Load finished on {product_settings}')
+            self.settings_repository.save_setting(target, wf_setting.workflow_key, last_loaded)
+            self.log.info(f'Load finished on {last_loaded}')
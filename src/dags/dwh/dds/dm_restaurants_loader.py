@@ -1,52 +1,87 @@
 from datetime import datetime
 from logging import Logger
-from typing import List, Optional
+from typing import Optional
 
-from bson.objectid import ObjectId
 from psycopg import Connection
 from pydantic import BaseModel, Field
 from lib.connect import PgConnect
 from lib.crud import PgReader, PgSaver
+from lib.etl_config import EtlConfig
 from lib.etl_settings_repository import EtlSettingsRepository
-
-
-class RestaurantObj(BaseModel):
-    object_id: Optional[str]
-    name: str
-    update_ts: datetime
-
-    def __lt__(self, other: 'RestaurantObj'):
-        return (self.update_ts, self.object_id) < (other.update_ts, other.object_id)
+from lib.utils import ACTIVE_TO_INF
 
 
 class RestaurantSettings(BaseModel, allow_population_by_field_name=True):
     last_loaded_ts: datetime = Field(alias='update_ts', default=datetime.min)
-    last_loaded_oid: str = Field(alias='object_id', default=str(ObjectId('0' * 24)))
+    last_loaded_oid: str = Field(alias='object_id', default='000000000000000000000000')
 
 
 class RestaurantsToStgWorkflow(PgReader, PgSaver):
 
-    def list_restaurants(self, source: Connection, rest_settings: RestaurantSettings, limit: int) -> List[RestaurantObj]:
-        restaurants = self.list(
-            conn=source,
-            model=RestaurantObj,
-            # Совмещаем данные ресторанов из двух подсистем, чтобы добиться согласованности данных
+    def load_restaurants(self, target: Connection, rest_settings: RestaurantSettings, limit: int) -> Optional[RestaurantSettings]:
+        # Создаем (если нужно) временную таблицу для пачки ресторанов.
+        self.insert(
+            conn=target,
             query="""
+                CREATE TEMP TABLE IF NOT EXISTS dm_restaurants_stg(
+                    restaurant_id VARCHAR,
+                    restaurant_name VARCHAR,
+                    active_from TIMESTAMP
+                )
+                ON COMMIT DELETE ROWS;
+            """,
+            params=None
+        )
+
+        # Переносим пачку ресторанов из stg-слоя во временную таблицу на стороне сервера и возвращаем ключ её последней строки.
+        last_loaded = self.retrieve(
+            conn=target,
+            model=RestaurantSettings,
+            # Совмещаем данные ресторанов из двух подсистем, чтобы добиться согласованности данных.
+            # В упорядоченной по дате выборке, оставляем данные до первого отсутствия ресторана в одной из подсистем.
+            query="""
+                WITH batch AS (
+                    SELECT
+                        object_id,
+                        name,
+                        update_ts
+                    FROM (
+                        SELECT
+                            dr.object_id,
+                            os.object_value_jsonb ->> 'name' AS name,
+                            os.update_ts,
+                            BOOL_AND(dr.object_id IS NOT NULL) OVER (ORDER BY os.update_ts, os.object_id) AS is_complete
+                        FROM
+                            stg.ordersystem_restaurants os
+                        LEFT JOIN
+                            stg.deliverysystem_restaurants dr ON dr.object_id = os.object_id
+                        WHERE
+                            (os.update_ts, os.object_id) > (%(ts_threshold)s, %(oid_threshold)s)
+                        ORDER BY
+                            os.update_ts, os.object_id
+                        LIMIT
+                            %(limit)s
+                    ) restaurants
+                    WHERE
+                        is_complete
+                ),
+                staged AS (
+                    INSERT INTO
+                        dm_restaurants_stg(restaurant_id, restaurant_name, active_from)
+                    SELECT
+                        object_id, name, update_ts
+                    FROM
+                        batch
+                )
                 SELECT
-                    dr.object_id,
-                    os.object_value::JSON ->> 'name' AS name,
-                    os.update_ts
+                    update_ts,
+                    object_id
                 FROM
-                    stg.ordersystem_restaurants os
-                LEFT JOIN
-                    stg.deliverysystem_restaurants dr ON dr.object_id = os.object_id
-                WHERE
-                    os.update_ts > %(ts_threshold)s OR
-                    (os.update_ts = %(ts_threshold)s AND os.object_id > %(oid_threshold)s)
-                ORDER BY 
-                    os.update_ts, os.object_id
+                    batch
+                ORDER BY
+                    update_ts DESC, object_id DESC
                 LIMIT
-                    %(limit)s;
+                    1;
             """,
             params={
                 'ts_threshold': rest_settings.last_loaded_ts,
@@ -55,82 +90,89 @@ class RestaurantsToStgWorkflow(PgReader, PgSaver):
             }
         )
 
-        # В упорядоченной по дате выборке, оставляем данные до первого отсутствия ресторана в одной из подсистем.
-        for idx, restaurant in enumerate(restaurants):
-            if not restaurant.object_id:
-                restaurants = restaurants[:idx]
-                break
+        # Если пачка пуста, в dds-слое нечего обновлять.
+        if not last_loaded:
+            return None
 
-        return restaurants
+        # Закрываем актуальные записи ресторанов, данные которых реально изменились.
+        self.insert(
+            conn=target,
+            query="""
+                UPDATE
+                    dds.dm_restaurants r
+                SET
+                    active_to = s.active_from
+                FROM
+                    dm_restaurants_stg s
+                WHERE
+                    r.restaurant_id = s.restaurant_id AND
+                    r.active_to = %(active_to)s AND
+                    r.restaurant_name IS DISTINCT FROM s.restaurant_name
+            """,
+            params={
+                'active_to': ACTIVE_TO_INF
+            },
+            prepare=True
+        )
 
-    def insert_restaurant(self, target: Connection, restaurant: RestaurantObj) -> None:
+        # Добавляем новые актуальные записи, одновременно очищая временную таблицу.
         self.insert(
             conn=target,
-            # При вставке ресторана, обновляем (если есть) последнюю запись ресторана, в случае реально новых данных.
             query="""
-                WITH update_restaurant_active_to AS (
-                    UPDATE
-                        dds.dm_restaurants r
-                    SET
-                        active_to = %(active_from)s
-                    FROM
-                        (SELECT MAX(id) AS id FROM dds.dm_restaurants WHERE restaurant_id = %(restaurant_id)s) latest
-                    WHERE
-                        r.id = latest.id AND
-                        r.restaurant_name != %(restaurant_name)s
+                WITH staged AS (
+                    DELETE FROM
+                        dm_restaurants_stg
+                    RETURNING
+                        restaurant_id, restaurant_name, active_from
                 )
                 INSERT INTO
                     dds.dm_restaurants(restaurant_id, restaurant_name, active_from, active_to)
-                VALUES
-                    (%(restaurant_id)s, %(restaurant_name)s, %(active_from)s, %(active_to)s)
+                SELECT
+                    restaurant_id, restaurant_name, active_from, %(active_to)s
+                FROM
+                    staged
                 ON CONFLICT
                     (restaurant_id, active_to)
                 DO NOTHING
             """,
             params={
-                'restaurant_id': restaurant.object_id,
-                'restaurant_name': restaurant.name,
-                'active_from': restaurant.update_ts,
-                'active_to': datetime(2099, 12, 31)
-            }
+                'active_to': ACTIVE_TO_INF
+            },
+            prepare=True
         )
 
+        return last_loaded
+
 
 class RestaurantsLoader:
     WF_KEY = 'restaurants_stg_to_dds_workflow'
-    BATCH_LIMIT = 2
+    BATCH_LIMIT = 1000
 
     def __init__(self, pg_origin: PgConnect, pg_dest: PgConnect, log: Logger) -> None:
         self.pg_origin = pg_origin
         self.pg_dest = pg_dest
         self.workflow = RestaurantsToStgWorkflow()
         self.settings_repository = EtlSettingsRepository(schema='dds')
+        self.batch_limit = EtlConfig.load().batch_limit(self.WF_KEY, self.BATCH_LIMIT)
         self.log = log
 
     def run(self):
-        # Открываем соединения.
-        with self.pg_origin.connection() as source, self.pg_dest.connection() as target:
+        # Открываем соединение: stg- и dds-слои лежат в одной базе dwh, поэтому пачка переносится на стороне сервера.
+        with self.pg_dest.connection() as target:
 
             # Прочитываем состояние загрузки.
             wf_setting = self.settings_repository.get_setting(target, self.WF_KEY)
             rest_settings = RestaurantSettings(**wf_setting.workflow_settings)
             self.log.info(f'Starting to load restaurants from last checkpoint: {rest_settings}')
 
-            # Вычитываем очередную пачку объектов.
-            load_queue = self.workflow.list_restaurants(source, rest_settings, self.BATCH_LIMIT)
-            self.log.info(f'Found {len(load_queue)} restaurants to load.')
+            # Переносим очередную пачку объектов в dds-слой.
+            last_loaded = self.workflow.load_restaurants(target, rest_settings, self.batch_limit)
 
             # Если нет объектов, выходим из процесса.
-            if not load_queue:
+            if not last_loaded:
                 self.log.info("Quitting.")
                 return
 
-            # Сохраняем объекты в базу dwh.
-            for restaurant in load_queue:
-                self.workflow.insert_restaurant(target, restaurant)
-
             # Сохраняем прогресс в базу dwh.
-            last_loaded_restaurant = max(load_queue)
-            rest_settings = RestaurantSettings(**last_loaded_restaurant.dict())
-            self.settings_repository.save_setting(target, wf_setting.workflow_key, rest_settings)
-            self.log.info(f'Load finished on {rest_settings}')
+            self.settings_repository.save_setting(target, wf_setting.workflow_key, last_loaded)
+            self.log.info(f'Load finished on {last_loaded}')
@@ -1,54 +1,87 @@
 from datetime import datetime
 from logging import Logger
-from typing import List, Optional
+from typing import Optional
 
-from bson.objectid import ObjectId
 from psycopg import Connection
 from pydantic import BaseModel, Field
 from lib.connect import PgConnect
 from lib.crud import PgReader, PgSaver
+from lib.etl_config import EtlConfig
 from lib.etl_settings_repository import EtlSettingsRepository
 
 
-class UserObj(BaseModel):
-    object_id: Optional[str] = Field(alias='order_user_id')
-    name: str
-    login: str
-    update_ts: datetime
-
-    def __lt__(self, other: 'UserObj'):
-        return (self.update_ts, self.object_id) < (other.update_ts, other.object_id)
-
-
 class UserSettings(BaseModel, allow_population_by_field_name=True):
     last_loaded_ts: datetime = Field(alias='update_ts', default=datetime.min)
-    last_loaded_oid: str = Field(alias='object_id', default=str(ObjectId('0' * 24)))
+    last_loaded_oid: str = Field(alias='object_id', default='000000000000000000000000')
 
 
 class UsersToStgWorkflow(PgReader, PgSaver):
 
-    def list_users(self, source: Connection, user_settings: UserSettings, limit: int) -> List[UserObj]:
-        users = self.list(
-            conn=source,
-            model=UserObj,
-            # Совмещаем данные пользователей из двух подсистем, чтобы добиться согласованности данных
+    def load_users(self, target: Connection, user_settings: UserSettings, limit: int) -> Optional[UserSettings]:
+        last_loaded = self.retrieve(
+            conn=target,
+            model=UserSettings,
+            # Совмещаем данные пользователей из двух подсистем, чтобы добиться согласованности данных.
+            # В упорядоченной по дате выборке, оставляем данные до первого отсутствия пользователя в одной из подсистем.
+            # Пачка переносится в dds-слой тем же запросом, а наружу возвращается только ключ её последней строки.
+            # Пользователь бонусной системы может встретиться в пачке несколько раз, поэтому вставляем последнюю версию,
+            # а неизменившиеся строки не перезаписываем.
             query="""
+                WITH batch AS (
+                    SELECT
+                        bonus_user_id,
+                        order_user_id,
+                        name,
+                        "login",
+                        update_ts
+                    FROM (
+                        SELECT
+                            bu.id AS bonus_user_id,
+                            bu.order_user_id,
+                            ou.object_value_jsonb ->> 'name' AS name,
+                            ou.object_value_jsonb ->> 'login' AS "login",
+                            ou.update_ts,
+                            BOOL_AND(bu.order_user_id IS NOT NULL) OVER (ORDER BY ou.update_ts, ou.object_id) AS is_complete
+                        FROM
+                            stg.ordersystem_users ou
+                        LEFT JOIN
+                            stg.bonussystem_users bu ON bu.order_user_id = ou.object_id
+                        WHERE
+                            (ou.update_ts, ou.object_id) > (%(ts_threshold)s, %(oid_threshold)s)
+                        ORDER BY
+                            ou.update_ts, ou.object_id
+                        LIMIT
+                            %(limit)s
+                    ) users
+                    WHERE
+                        is_complete
+                ),
+                merged AS (
+                    INSERT INTO
+                        dds.dm_users(user_id, user_name, user_login)
+                    SELECT DISTINCT ON (order_user_id)
+                        order_user_id, name, "login"
+                    FROM
+                        batch
+                    ORDER BY
+                        order_user_id, bonus_user_id DESC
+                    ON CONFLICT
+                        (user_id)
+                    DO UPDATE SET
+                        user_name = EXCLUDED.user_name,
+                        user_login = EXCLUDED.user_login
+                    WHERE
+                        (dm_users.user_name, dm_users.user_login) IS DISTINCT FROM (EXCLUDED.user_name, EXCLUDED.user_login)
+                )
                 SELECT
-                    bu.order_user_id,
-                    ou.object_value::JSON ->> 'name' AS name,
-                    ou.object_value::JSON ->> 'login' AS "login",
-                    ou.update_ts
+                    update_ts,
+                    order_user_id AS object_id
                 FROM
-                    stg.ordersystem_users ou
-                LEFT JOIN
-                    stg.bonussystem_users bu ON bu.order_user_id = ou.object_id
-                WHERE
-                    ou.update_ts > %(ts_threshold)s OR
-                    (ou.update_ts = %(ts_threshold)s AND ou.object_id > %(oid_threshold)s)
+                    batch
                 ORDER BY
-                    ou.update_ts, ou.object_id
+                    update_ts DESC, order_user_id DESC
                 LIMIT
-                    %(limit)s;
+                    1;
             """,
             params={
                 'ts_threshold': user_settings.last_loaded_ts,
@@ -57,34 +90,7 @@ class UsersToStgWorkflow(PgReader, PgSaver):
             }
         )
 
-        # В упорядоченной по дате выборке, оставляем данные до первого отсутствия пользователя в одной из подсистем
-        for idx, user in enumerate(users):
-            if not user.object_id:
-                users = users[:idx]
-                break
-
-        return users
-
-    def insert_user(self, target: Connection, user: UserObj) -> None:
-        self.insert(
-            conn=target,
-            query="""
-                INSERT INTO
-                    dds.dm_users(user_id, user_name, user_login)
-                VALUES
-                    (%(user_id)s, %(user_name)s, %(user_login)s)
-                ON CONFLICT
-                    (user_id)
-                DO UPDATE SET
-                    user_name = EXCLUDED.user_name,
-                    user_login = EXCLUDED.user_login;
-            """,
-            params={
-                'user_id': user.object_id,
-                'user_name': user.name,
-                'user_login': user.login
-            }
-        )
+        return last_loaded
 
 
 class UsersLoader:
@@ -96,32 +102,26 @@ class UsersLoader:
         self.pg_dest = pg_dest
         self.workflow = UsersToStgWorkflow()
         self.settings_repository = EtlSettingsRepository(schema='dds')
+        self.batch_limit = EtlConfig.load().batch_limit(self.WF_KEY, self.BATCH_LIMIT)
         self.log = log
 
     def run(self):
-        # Открываем соединения.
-        with self.pg_origin.connection() as source, self.pg_dest.connection() as target:
+        # Открываем соединение: stg- и dds-слои лежат в одной базе dwh, поэтому пачка переносится на стороне сервера.
+        with self.pg_dest.connection() as target:
 
             # Прочитываем состояние загрузки.
             wf_setting = self.settings_repository.get_setting(target, self.WF_KEY)
             user_settings = UserSettings(**wf_setting.workflow_settings)
             self.log.info(f'Starting to load users from last checkpoint: {user_settings}')
 
-            # Вычитываем очередную пачку объектов.
-            load_queue = self.workflow.list_users(source, user_settings, self.BATCH_LIMIT)
-            self.log.info(f'Found {len(load_queue)} users to load.')
+            # Переносим очередную пачку объектов в dds-слой.
+            last_loaded = self.workflow.load_users(target, user_settings, self.batch_limit)
 
             # Если нет объектов, выходим из процесса.
-            if not load_queue:
+            if not last_loaded:
                 self.log.info('Quitting.')
                 return
 
-            # Сохраняем объекты в базу dwh.
-            for user in load_queue:
-                self.workflow.insert_user(target, user)
-
             # Сохраняем прогресс в базу dwh.
-            last_loaded_user = max(load_queue)
-            user_settings = UserSettings(**last_loaded_user.dict())
-            self.settings_repository.save_setting(target, wf_setting.workflow_key, user_settings)
-            self.log.info(f'Load finished on {user_settings}')
+            self.settings_repository.save_setting(target, wf_setting.workflow_key, last_loaded)
+            self.log.info(f'Load finished on {last_loaded}')
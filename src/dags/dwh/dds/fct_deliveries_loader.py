@@ -1,69 +1,92 @@
 from logging import Logger
-from typing import List, Optional
+from typing import Optional
 
 from psycopg import Connection
 from pydantic import BaseModel, Field
 from lib.connect import PgConnect
 from lib.crud import PgReader, PgSaver
+from lib.etl_config import EtlConfig
 from lib.etl_settings_repository import EtlSettingsRepository
 
 
-class DeliveryObj(BaseModel):
-    id: int
-    address: str
-    rate: int
-    tip_sum: float
-    sum: float
-    order_fk: Optional[str]
-    courier_fk: Optional[str]
-
-    def __lt__(self, other: 'DeliveryObj'):
-        return self.id < other.id
-
-
 class DeliverySettings(BaseModel, allow_population_by_field_name=True):
     last_loaded_id: int = Field(alias='id', default=-1)
 
 
 class DeliveriesToDdsWorkflow(PgReader, PgSaver):
 
-    def list_deliveries(self, source: Connection, delivery_settings: DeliverySettings, limit: int) -> List[DeliveryObj]:
-        deliveries = super().list(
-            conn=source,
-            model=DeliveryObj,
-            # Совмещаем данные продаж из stg-слоя и связанных сущностей dds-слоя, для получения внешних ключей
+    def load_deliveries(self, target: Connection, delivery_settings: DeliverySettings, limit: int) -> Optional[DeliverySettings]:
+        last_loaded = super().retrieve(
+            conn=target,
+            model=DeliverySettings,
+            # Совмещаем данные доставок из stg-слоя и связанных сущностей dds-слоя, для получения внешних ключей.
+            # Заказы и курьеры уникальны по внешнему ключу, поэтому каждое соединение находит не более одной строки.
+            # В упорядоченной выборке, оставляем данные до первого отсутствия внешнего ключа какой-либо сущности.
+            # Пачка переносится в dds-слой тем же запросом, а наружу возвращается только ключ её последней строки.
             query="""
+                WITH batch AS (
+                    SELECT
+                        id,
+                        address,
+                        rate,
+                        tip_sum,
+                        "sum",
+                        order_fk,
+                        courier_fk
+                    FROM (
+                        SELECT
+                            sd.id,
+                            delivery.address,
+                            delivery.rate,
+                            delivery.tip_sum,
+                            delivery.sum,
+                            "do".id AS order_fk,
+                            dc.id AS courier_fk,
+                            BOOL_AND("do".id IS NOT NULL AND dc.id IS NOT NULL) OVER (ORDER BY sd.id) AS is_complete
+                        FROM
+                            stg.deliverysystem_deliveries sd
+                        CROSS JOIN
+                            json_to_record(sd.delivery_value::JSON) AS delivery(
+                                order_id VARCHAR,
+                                courier_id VARCHAR,
+                                address VARCHAR,
+                                rate INT,
+                                tip_sum NUMERIC(14, 2),
+                                "sum" NUMERIC(14, 2)
+                            )
+                        LEFT JOIN
+                            dds.dm_orders "do" ON "do".order_key = delivery.order_id
+                        LEFT JOIN
+                            dds.dm_couriers dc ON dc.courier_id = delivery.courier_id
+                        WHERE
+                            sd.id > %(id_threshold)s
+                        ORDER BY
+                            sd.id
+                        LIMIT
+                            %(limit)s
+                    ) deliveries
+                    WHERE
+                        is_complete
+                ),
+                merged AS (
+                    INSERT INTO
+                        dds.fct_deliveries(courier_id, order_id, address, rate, tip_sum, sum)
+                    SELECT
+                        courier_fk, order_fk, address, rate, tip_sum, "sum"
+                    FROM
+                        batch
+                    ON CONFLICT
+                        (courier_id, order_id)
+                    DO NOTHING
+                )
                 SELECT
-                    sd.id,
-                    delivery.address,
-                    delivery.rate,
-                    delivery.tip_sum,
-                    delivery.sum,
-                    MAX("do".id) AS order_fk,
-                    MAX(dc.id) AS courier_fk
+                    id
                 FROM
-                    stg.deliverysystem_deliveries sd
-                CROSS JOIN
-                    json_to_record(sd.delivery_value::JSON) AS delivery(
-                        order_id VARCHAR,
-                        courier_id VARCHAR,
-                        address VARCHAR,
-                        rate INT,
-                        tip_sum NUMERIC(14, 2),
-                        "sum" NUMERIC(14, 2)
-                    )
-                LEFT JOIN
-                    dds.dm_orders "do" ON "do".order_key = delivery.order_id
-                LEFT JOIN
-                    dds.dm_couriers dc ON dc.courier_id = delivery.courier_id
-                WHERE
-                    sd.id > %(id_threshold)s
-                GROUP BY
-                    sd.id, delivery.address, delivery.rate, delivery.tip_sum, delivery.sum
+                    batch
                 ORDER BY
-                    sd.id
+                    id DESC
                 LIMIT
-                    %(limit)s;
+                    1;
             """,
             params={
                 'id_threshold': delivery_settings.last_loaded_id,
@@ -71,35 +94,7 @@ class DeliveriesToDdsWorkflow(PgReader, PgSaver):
             }
         )
 
-        # В упорядоченной по дате выборке, оставляем данные до первого отсутствия внешнего ключа какой-либо сущности.
-        for idx, delivery in enumerate(deliveries):
-            if not all([delivery.order_fk, delivery.courier_fk]):
-                deliveries = deliveries[:idx]
-                break
-
-        return deliveries
-
-    def insert_delivery(self, target: Connection, delivery: DeliveryObj) -> None:
-        super().insert(
-            conn=target,
-            query="""
-                INSERT INTO
-                    dds.fct_deliveries(courier_id, order_id, address, rate, tip_sum, sum)
-                VALUES
-                    (%(courier_id)s, %(order_id)s, %(address)s, %(rate)s, %(tip_sum)s, %(sum)s)
-                ON CONFLICT
-                    (courier_id, order_id)
-                DO NOTHING
-            """,
-            params={
-                'courier_id': delivery.courier_fk,
-                'order_id': delivery.order_fk,
-                'address': delivery.address, 
-                'rate': delivery.rate,
-                'tip_sum': delivery.tip_sum,
-                'sum': delivery.sum
-            }
-        )
+        return last_loaded
 
 
 class DeliveriesLoader:
@@ -111,32 +106,26 @@ class DeliveriesLoader:
         self.pg_dest = pg_dest
         self.workflow = DeliveriesToDdsWorkflow()
         self.settings_repository = EtlSettingsRepository(schema='dds')
+        self.batch_limit = EtlConfig.load().batch_limit(self.WF_KEY, self.BATCH_LIMIT)
         self.log = log
 
     def run(self):
-        # Открываем соединения.
-        with self.pg_origin.connection() as source, self.pg_dest.connection() as target:
+        # Открываем соединение: stg- и dds-слои лежат в одной базе dwh, поэтому пачка переносится на стороне сервера.
+        with self.pg_dest.connection() as target:
 
             # Прочитываем состояние загрузки.
             wf_setting = self.settings_repository.get_setting(target, self.WF_KEY)
             delivery_settings = DeliverySettings(**wf_setting.workflow_settings)
             self.log.info(f'Starting to load deliveries from last checkpoint: {delivery_settings}')
 
-            # Вычитываем очередную пачку объектов.
-            load_queue = self.workflow.list_deliveries(source, delivery_settings, self.BATCH_LIMIT)
-            self.log.info(f'Found {len(load_queue)} deliveries to load.')
+            # Переносим очередную пачку объектов в dds-слой.
+            last_loaded = self.workflow.load_deliveries(target, delivery_settings, self.batch_limit)
 
             # Если нет объектов, выходим из процесса.
-            if not load_queue:
+            if not last_loaded:
                 self.log.info('Quitting.')
                 return
 
-            # Сохраняем объекты в базу dwh.
-            for delivery in load_queue:
-                self.workflow.insert_delivery(target, delivery)
-
             # Сохраняем прогресс в базу dwh.
-            last_loaded_delivery = max(load_queue)
-            delivery_settings = DeliverySettings(**last_loaded_delivery.dict())
-            self.settings_repository.save_setting(target, wf_setting.workflow_key, delivery_settings)
-            self.log.info(f'Load finished on {delivery_settings}')
+            self.settings_repository.save_setting(target, wf_setting.workflow_key, last_loaded)
+            self.log.info(f'Load finished on {last_loaded}')
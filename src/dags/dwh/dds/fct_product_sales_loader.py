@@ -1,123 +1,139 @@
 from datetime import datetime
+from decimal import Decimal
 from logging import Logger
-from typing import List, Optional
+from typing import Iterator, List, Optional
 
-from bson.objectid import ObjectId
 from psycopg import Connection
 from pydantic import BaseModel, Field
 from lib.connect import PgConnect
 from lib.crud import PgReader, PgSaver
+from lib.etl_config import EtlConfig
 from lib.etl_settings_repository import EtlSettingsRepository
+from lib.utils import ACTIVE_TO_INF, chunked
 
 
 class ProductSaleObj(BaseModel):
     product_id: str
-    price: float
+    price: Decimal
     quantity: int
-    bonus_payment: float
-    bonus_grant: float
+    bonus_payment: Decimal
+    bonus_grant: Decimal
     event_ts: datetime
-    order_fk: Optional[str]
-    product_fk: Optional[str]
-
-    def __lt__(self, other: 'ProductSaleObj'):
-        return (self.event_ts, self.product_id) < (other.event_ts, other.product_id)
+    order_fk: Optional[int]
+    product_fk: Optional[int]
 
 
 class ProductSaleSettings(BaseModel, allow_population_by_field_name=True):
     last_loaded_ts: datetime = Field(alias='event_ts', default=datetime.min)
-    last_loaded_product_id: str = Field(alias='product_id', default=str(ObjectId('0' * 24)))
+    last_loaded_product_id: str = Field(alias='product_id', default='000000000000000000000000')
 
 
 class ProductSalesToDdsWorkflow(PgReader, PgSaver):
 
-    def list_sales(self, source: Connection, sale_settings: ProductSaleSettings, limit: int) -> List[ProductSaleObj]:
-        product_sales = super().list(
+    def list_sales(self, source: Connection, sale_settings: ProductSaleSettings, limit: int) -> Iterator[ProductSaleObj]:
+        product_sales = super().stream(
             conn=source,
             model=ProductSaleObj,
-            # Совмещаем данные продаж из stg-слоя и связанных сущностей dds-слоя, для получения внешних ключей
+            # Совмещаем данные продаж из stg-слоя и связанных сущностей dds-слоя, для получения внешних ключей.
+            # Заказ уникален по ключу, а у продукта берем только актуальную версию, поэтому каждое соединение находит не более одной строки.
+            # В упорядоченной по дате выборке, оставляем данные до первого отсутствия внешнего ключа какой-либо сущности.
             query="""
                 SELECT
-                    product.product_id,
-                    product.price,
-                    product.quantity,
-                    product.bonus_payment,
-                    product.bonus_grant,
-                    be.event_ts,
-                    MAX("do".id) AS order_fk,
-                    MAX(dp.id) AS product_fk
-                FROM
-                    stg.bonussystem_events be
-                CROSS JOIN
-                    json_to_recordset(be.event_value::JSON -> 'product_payments') AS product(
-                        product_id VARCHAR,
-                        price NUMERIC(14,2),
-                        quantity INT,
-                        bonus_payment NUMERIC(14,2),
-                        bonus_grant NUMERIC(14,2)
-                    )
-                LEFT JOIN
-                    dds.dm_orders "do" ON "do".order_key = be.event_value::JSON ->> 'order_id'
-                LEFT JOIN
-                    dds.dm_products dp ON dp.product_id = product.product_id
+                    product_id,
+                    price,
+                    quantity,
+                    bonus_payment,
+                    bonus_grant,
+                    event_ts,
+                    order_fk,
+                    product_fk
+                FROM (
+                    SELECT
+                        product.product_id,
+                        product.price,
+                        product.quantity,
+                        product.bonus_payment,
+                        product.bonus_grant,
+                        be.event_ts,
+                        "do".id AS order_fk,
+                        dp.id AS product_fk,
+                        BOOL_AND("do".id IS NOT NULL AND dp.id IS NOT NULL) OVER (ORDER BY be.event_ts, product.product_id) AS is_complete
+                    FROM
+                        stg.bonussystem_events be
+                    CROSS JOIN
+                        jsonb_to_recordset(be.product_payments) AS product(
+                            product_id VARCHAR,
+                            price NUMERIC(14,2),
+                            quantity INT,
+                            bonus_payment NUMERIC(14,2),
+                            bonus_grant NUMERIC(14,2)
+                        )
+                    LEFT JOIN
+                        dds.dm_orders "do" ON "do".order_key = be.order_id
+                    LEFT JOIN
+                        dds.dm_products dp ON dp.product_id = product.product_id AND dp.active_to = %(active_to)s
+                    WHERE
+                        (be.event_ts, product.product_id) > (%(ts_threshold)s, %(oid_threshold)s)
+                    ORDER BY
+                        be.event_ts, product.product_id
+                    LIMIT
+                        %(limit)s
+                ) product_sales
                 WHERE
-                    be.event_ts > %(ts_threshold)s OR
-                    (be.event_ts = %(ts_threshold)s AND product.product_id > %(oid_threshold)s)
-                GROUP BY
-                    be.event_ts, product.product_id, product.price, product.quantity, product.bonus_payment, product.bonus_grant
+                    is_complete
                 ORDER BY
-                    be.event_ts, product.product_id
-                LIMIT
-                    %(limit)s;
+                    event_ts, product_id;
             """,
             params={
                 'ts_threshold': sale_settings.last_loaded_ts,
                 'oid_threshold': sale_settings.last_loaded_product_id,
+                'active_to': ACTIVE_TO_INF,
                 'limit': limit
             }
         )
 
-        # В упорядоченной по дате выборке, оставляем данные до первого отсутствия внешнего ключа какой-либо сущности.
-        for idx, product_sale in enumerate(product_sales):
-            if not all([product_sale.order_fk, product_sale.product_fk]):
-                product_sales = product_sales[:idx]
-                break
-
         return product_sales
 
-    def insert_sale(self, target: Connection, product_sale: ProductSaleObj) -> None:
-        super().insert(
+    def insert_sales(self, target: Connection, product_sales: List[ProductSaleObj]) -> None:
+        super().insert_many(
             conn=target,
             query="""
                 INSERT INTO
                     dds.fct_product_sales(product_id, order_id, count, price, total_sum, bonus_payment, bonus_grant)
                 VALUES
-                    (%(product_id)s, %(order_id)s, %(count)s, %(price)s, %(total_sum)s, %(bonus_payment)s, %(bonus_grant)s)
+                    (%s, %s, %s, %s, %s, %s, %s)
                 ON CONFLICT
                     (product_id, order_id)
                 DO NOTHING
             """,
-            params={
-                'order_id': product_sale.order_fk,
-                'product_id': product_sale.product_fk,
-                'count': product_sale.quantity, 
-                'price': product_sale.price,
-                'total_sum': product_sale.quantity * product_sale.price,
-                'bonus_payment': product_sale.bonus_payment,
-                'bonus_grant': product_sale.bonus_grant
-            }
+            params_seq=[
+                (
+                    product_sale.product_fk,
+                    product_sale.order_fk,
+                    product_sale.quantity,
+                    product_sale.price,
+                    product_sale.quantity * product_sale.price,
+                    product_sale.bonus_payment,
+                    product_sale.bonus_grant
+                )
+                for product_sale in product_sales
+            ]
         )
 
 
 class ProductSalesLoader:
     WF_KEY = 'product_sales_stg_to_dds_workflow'
     BATCH_LIMIT = 10000
+    FLUSH_SIZE = 1000
 
     def __init__(self, pg_origin: PgConnect, pg_dest: PgConnect, log: Logger) -> None:
         self.pg_origin = pg_origin
         self.pg_dest = pg_dest
         self.workflow = ProductSalesToDdsWorkflow()
         self.settings_repository = EtlSettingsRepository(schema='dds')
+        etl_config = EtlConfig.load()
+        self.batch_limit = etl_config.batch_limit(self.WF_KEY, self.BATCH_LIMIT)
+        self.flush_size = etl_config.flush_size(self.WF_KEY, self.FLUSH_SIZE)
         self.log = log
 
     def run(self):
@@ -129,21 +145,21 @@ class ProductSalesLoader:
             sale_settings = ProductSaleSettings(**wf_setting.workflow_settings)
             self.log.info(f'Starting to load product sales from last checkpoint: {sale_settings}')
 
-            # Вычитываем очередную пачку объектов.
-            load_queue = self.workflow.list_sales(source, sale_settings, self.BATCH_LIMIT)
-            self.log.info(f'Found {len(load_queue)} product sales to load.')
+            # Вычитываем объекты потоком и сохраняем их в базу dwh пачками.
+            processed = 0
+            last_loaded_sale = None
+            for load_queue in chunked(self.workflow.list_sales(source, sale_settings, self.batch_limit), self.flush_size):
+                self.workflow.insert_sales(target, load_queue)
+                processed += len(load_queue)
+                last_loaded_sale = load_queue[-1]
+            self.log.info(f'Loaded {processed} product sales.')
 
             # Если нет объектов, выходим из процесса.
-            if not load_queue:
+            if not last_loaded_sale:
                 self.log.info('Quitting.')
                 return
 
-            # Сохраняем объекты в базу dwh.
-            for product_sale in load_queue:
-                self.workflow.insert_sale(target, product_sale)
-
             # Сохраняем прогресс в базу dwh.
-            last_loaded_sale = max(load_queue)
             sale_settings = ProductSaleSettings(**last_loaded_sale.dict())
             self.settings_repository.save_setting(target, wf_setting.workflow_key, sale_settings)
             self.log.info(f'Load finished on {sale_settings}')
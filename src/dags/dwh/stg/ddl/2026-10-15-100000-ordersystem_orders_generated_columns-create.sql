@@ -0,0 +1,5 @@
+ALTER TABLE stg.ordersystem_orders
+    ADD COLUMN IF NOT EXISTS final_status VARCHAR GENERATED ALWAYS AS (object_value::JSONB ->> 'final_status') STORED,
+    ADD COLUMN IF NOT EXISTS user_external_id VARCHAR GENERATED ALWAYS AS (object_value::JSONB #>> '{user,id}') STORED,
+    ADD COLUMN IF NOT EXISTS restaurant_external_id VARCHAR GENERATED ALWAYS AS (object_value::JSONB #>> '{restaurant,id}') STORED,
+    ADD COLUMN IF NOT EXISTS order_date VARCHAR GENERATED ALWAYS AS (object_value::JSONB ->> 'date') STORED;
@@ -0,0 +1 @@
+CREATE INDEX IF NOT EXISTS idx_ordersystem_orders__update_ts_object_id ON stg.ordersystem_orders USING BTREE(update_ts, object_id);
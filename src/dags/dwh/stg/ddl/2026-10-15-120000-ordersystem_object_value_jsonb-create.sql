@@ -0,0 +1,4 @@
+ALTER TABLE stg.ordersystem_restaurants
+    ADD COLUMN IF NOT EXISTS object_value_jsonb JSONB GENERATED ALWAYS AS (object_value::JSONB) STORED;
+ALTER TABLE stg.ordersystem_users
+    ADD COLUMN IF NOT EXISTS object_value_jsonb JSONB GENERATED ALWAYS AS (object_value::JSONB) STORED;
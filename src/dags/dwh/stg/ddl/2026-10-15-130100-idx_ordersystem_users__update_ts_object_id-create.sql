@@ -0,0 +1 @@
+CREATE INDEX IF NOT EXISTS idx_ordersystem_users__update_ts_object_id ON stg.ordersystem_users USING BTREE(update_ts, object_id);
@@ -0,0 +1,3 @@
+ALTER TABLE stg.bonussystem_events
+    ADD COLUMN IF NOT EXISTS order_id VARCHAR GENERATED ALWAYS AS (event_value::JSONB ->> 'order_id') STORED,
+    ADD COLUMN IF NOT EXISTS product_payments JSONB GENERATED ALWAYS AS (event_value::JSONB -> 'product_payments') STORED;
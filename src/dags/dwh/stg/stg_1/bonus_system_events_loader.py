@@ -6,6 +6,7 @@ import psycopg
 from pydantic import BaseModel, Field
 from lib.connect import PgConnect
 from lib.crud import PgReader, PgSaver
+from lib.etl_config import EtlConfig
 from lib.etl_settings_repository import EtlSettingsRepository
 
 
@@ -15,9 +16,6 @@ class EventObj(BaseModel):
     event_type: str
     event_value: str
 
-    def __lt__(self, other: 'EventObj'):
-        return self.id < other.id
-
 
 class EventSettings(BaseModel, allow_population_by_field_name=True):
     last_loaded_ts: datetime = Field(alias='event_ts')
@@ -36,8 +34,7 @@ class EventsToStgWorkflow(PgReader, PgSaver):
                 FROM
                     outbox
                 WHERE
-                    event_ts > %(ts_threshold)s OR
-                    (event_ts = %(ts_threshold)s AND id > %(id_threshold)s)
+                    (event_ts, id) > (%(ts_threshold)s, %(id_threshold)s)
                 ORDER BY
                     event_ts, id
                 LIMIT
@@ -51,14 +48,41 @@ class EventsToStgWorkflow(PgReader, PgSaver):
         )
         return events
 
-    def insert_event(self, target: psycopg.Connection, event: EventObj) -> None:
+    def insert_events(self, target: psycopg.Connection, events: List[EventObj]) -> None:
+        # Загружаем пачку событий во временную таблицу через COPY.
+        super().copy(
+            conn=target,
+            staging="""
+                CREATE TEMP TABLE IF NOT EXISTS bonussystem_events_stg(
+                    id INT,
+                    event_ts TIMESTAMP,
+                    event_type VARCHAR,
+                    event_value TEXT
+                )
+                ON COMMIT DELETE ROWS;
+            """,
+            query="""
+                COPY bonussystem_events_stg(id, event_ts, event_type, event_value) FROM STDIN
+            """,
+            rows=((event.id, event.event_ts, event.event_type, event.event_value) for event in events)
+        )
+
+        # Переносим пачку в stg-слой, одновременно очищая временную таблицу.
         super().insert(
             conn=target,
             query="""
+                WITH staged AS (
+                    DELETE FROM
+                        bonussystem_events_stg
+                    RETURNING
+                        id, event_ts, event_type, event_value
+                )
                 INSERT INTO
                     stg.bonussystem_events(id, event_ts, event_type, event_value)
-                VALUES
-                    (%(id)s, %(event_ts)s, %(event_type)s, %(event_value)s)
+                SELECT
+                    id, event_ts, event_type, event_value
+                FROM
+                    staged
                 ON CONFLICT
                     (id)
                 DO UPDATE SET
@@ -66,12 +90,8 @@ class EventsToStgWorkflow(PgReader, PgSaver):
                     event_type = EXCLUDED.event_type,
                     event_value = EXCLUDED.event_value;
             """,
-            params={
-                'id': event.id,
-                'event_ts': event.event_ts,
-                'event_type': event.event_type,
-                'event_value': event.event_value
-            }
+            params=None,
+            prepare=True
         )
 
 
@@ -84,11 +104,12 @@ class EventsLoader:
         self.pg_dest = pg_dest
         self.workflow = EventsToStgWorkflow()
         self.settings_repository = EtlSettingsRepository(schema='stg')
+        self.batch_limit = EtlConfig.load().batch_limit(self.WF_KEY, self.BATCH_LIMIT)
         self.log = log
 
     def run(self, start_date: datetime):
         # Открываем соединения.
-        with self.pg_origin.connection() as source, self.pg_dest.connection() as target:
+        with self.pg_origin.connection() as source, self.pg_dest.connection(synchronous_commit=False) as target:
 
             # Прочитываем состояние загрузки.
             wf_setting = self.settings_repository.get_setting(target, self.WF_KEY)
@@ -99,7 +120,7 @@ class EventsLoader:
             self.log.info(f'Starting to load events from last checkpoint: {event_settings}')
 
             # Вычитываем очередную пачку объектов.
-            load_queue = self.workflow.list_events(source, event_settings, self.BATCH_LIMIT)
+            load_queue = self.workflow.list_events(source, event_settings, self.batch_limit)
             self.log.info(f'Found {len(load_queue)} events to load.')
 
             # Если нет объектов, выходим из процесса.
@@ -107,12 +128,11 @@ class EventsLoader:
                 self.log.info('Quitting.')
                 return
 
-            # Сохраняем объекты в базу dwh.
-            for event in load_queue:
-                self.workflow.insert_event(target, event)
+            # Сохраняем объекты в базу dwh одним пакетом.
+            self.workflow.insert_events(target, load_queue)
 
             # Сохраняем прогресс в базу dwh.
-            last_loaded_event = max(load_queue)
+            last_loaded_event = load_queue[-1]
             event_settings = EventSettings(**last_loaded_event.dict())
             self.settings_repository.save_setting(target, wf_setting.workflow_key, event_settings)
             self.log.info(f'Load finished on {event_settings}')
@@ -1,9 +1,11 @@
+from decimal import Decimal
 from logging import Logger
 from typing import List
 
 import psycopg
 from pydantic import BaseModel, Field
 from lib.crud import PgReader, PgSaver
+from lib.etl_config import EtlConfig
 from lib.etl_settings_repository import EtlSettingsRepository
 from lib.connect import PgConnect
 
@@ -11,11 +13,8 @@ from lib.connect import PgConnect
 class RankObj(BaseModel):
     id: int
     name: str
-    bonus_percent: float
-    min_payment_threshold: float
-
-    def __lt__(self, other: 'RankObj'):
-        return self.id < other.id
+    bonus_percent: Decimal
+    min_payment_threshold: Decimal
 
 
 class RankSettings(BaseModel, allow_population_by_field_name=True):
@@ -48,45 +47,40 @@ class RanksToStgWorkrlow(PgReader, PgSaver):
         )
         return ranks
 
-    def insert_rank(self, target: psycopg.Connection, rank: RankObj) -> None:
-        super().insert(
+    def insert_ranks(self, target: psycopg.Connection, ranks: List[RankObj]) -> None:
+        super().insert_many(
             conn=target,
-            query=(
-            """
+            query="""
                 INSERT INTO 
                     stg.bonussystem_ranks(id, name, bonus_percent, min_payment_threshold)
                 VALUES
-                    (%(id)s, %(name)s, %(bonus_percent)s, %(min_payment_threshold)s)
+                    (%s, %s, %s, %s)
                 ON CONFLICT 
                     (id)
                 DO UPDATE SET
                     name = EXCLUDED.name,
                     bonus_percent = EXCLUDED.bonus_percent,
                     min_payment_threshold = EXCLUDED.min_payment_threshold;
-            """),
-            params={
-                'id': rank.id,
-                'name': rank.name,
-                'bonus_percent': rank.bonus_percent,
-                'min_payment_threshold': rank.min_payment_threshold
-            }
+            """,
+            params_seq=[(rank.id, rank.name, rank.bonus_percent, rank.min_payment_threshold) for rank in ranks]
         )
 
 
 class RanksLoader:
     WF_KEY = 'bonussystem_ranks_origin_to_stg_workflow'
-    BATCH_LIMIT = 2
+    BATCH_LIMIT = 10000
 
     def __init__(self, pg_origin: PgConnect, pg_dest: PgConnect, log: Logger) -> None:
         self.pg_origin = pg_origin
         self.pg_dest = pg_dest
         self.workflow = RanksToStgWorkrlow()
         self.settings_repository = EtlSettingsRepository(schema='stg')
+        self.batch_limit = EtlConfig.load().batch_limit(self.WF_KEY, self.BATCH_LIMIT)
         self.log = log
 
     def run(self):
         # Открываем соединения.
-        with self.pg_origin.connection() as source, self.pg_dest.connection() as target:
+        with self.pg_origin.connection() as source, self.pg_dest.connection(synchronous_commit=False) as target:
 
             # Прочитываем состояние загрузки.
             wf_setting = self.settings_repository.get_setting(target, self.WF_KEY)
@@ -94,7 +88,7 @@ class RanksLoader:
             self.log.info(f'Starting to load ranks from last checkpoint: {rank_settings}')
 
             # Вычитываем очередную пачку объектов.
-            load_queue = self.workflow.list_ranks(source, rank_settings, self.BATCH_LIMIT)
+            load_queue = self.workflow.list_ranks(source, rank_settings, self.batch_limit)
             self.log.info(f'Found {len(load_queue)} ranks to load.')
 
             # Если нет объектов, выходим из процесса.
@@ -102,13 +96,11 @@ class RanksLoader:
                 self.log.info('Quitting.')
                 return
 
-            # Сохраняем объекты в базу dwh.
-            for rank in load_queue:
-                self.workflow.insert_rank(target, rank)
-
-            # Сохраняем прогресс в базу dwh.
-            last_loaded_rank = max(load_queue)
+            # Сохраняем объекты и прогресс в базу dwh, отправляя запросы конвейером без ожидания ответов.
+            last_loaded_rank = load_queue[-1]
             rank_settings = RankSettings(**last_loaded_rank.dict())
-            self.settings_repository.save_setting(target, wf_setting.workflow_key, rank_settings)
+            with target.pipeline():
+                self.workflow.insert_ranks(target, load_queue)
+                self.settings_repository.save_setting(target, wf_setting.workflow_key, rank_settings)
             self.log.info(f'Load finished on {rank_settings}')
 
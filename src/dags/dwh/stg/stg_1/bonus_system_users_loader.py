@@ -5,6 +5,7 @@ import psycopg
 from pydantic import BaseModel, Field
 from lib.connect import PgConnect
 from lib.crud import PgReader, PgSaver
+from lib.etl_config import EtlConfig
 from lib.etl_settings_repository import EtlSettingsRepository
 
 
@@ -12,9 +13,6 @@ class UserObj(BaseModel):
     id: int
     order_user_id: str
 
-    def __lt__(self, other: 'UserObj'):
-        return self.id < other.id
-
 
 class UserSettings(BaseModel, allow_population_by_field_name=True):
     last_loaded_id: int = Field(alias='id', default=-1)
@@ -45,23 +43,20 @@ class UsersToStgWorkflow(PgReader, PgSaver):
         )
         return users
 
-    def insert_user(self, target: psycopg.Connection, user: UserObj) -> None:
-        super().insert(
+    def insert_users(self, target: psycopg.Connection, users: List[UserObj]) -> None:
+        super().insert_many(
             conn=target,
             query="""
                 INSERT INTO
                     stg.bonussystem_users(id, order_user_id)
                 VALUES
-                    (%(id)s, %(order_user_id)s)
+                    (%s, %s)
                 ON CONFLICT
                     (id)
                 DO UPDATE SET
                     order_user_id = EXCLUDED.order_user_id;
             """,
-            params={
-                'id': user.id,
-                'order_user_id': user.order_user_id
-            }
+            params_seq=[(user.id, user.order_user_id) for user in users]
         )
 
 
@@ -74,11 +69,12 @@ class UsersLoader:
         self.pg_dest = pg_dest
         self.workflow = UsersToStgWorkflow()
         self.settings_repository = EtlSettingsRepository(schema='stg')
+        self.batch_limit = EtlConfig.load().batch_limit(self.WF_KEY, self.BATCH_LIMIT)
         self.log = log
 
     def run(self):
         # Открываем соединения.
-        with self.pg_origin.connection() as source, self.pg_dest.connection() as target:
+        with self.pg_origin.connection() as source, self.pg_dest.connection(synchronous_commit=False) as target:
 
             # Прочитываем состояние загрузки.
             wf_setting = self.settings_repository.get_setting(target, self.WF_KEY)
@@ -86,7 +82,7 @@ class UsersLoader:
             self.log.info(f'Starting to load users from last checkpoint: {user_settings}')
 
             # Вычитываем очередную пачку объектов.
-            load_queue = self.workflow.list_users(source, user_settings, self.BATCH_LIMIT)
+            load_queue = self.workflow.list_users(source, user_settings, self.batch_limit)
             self.log.info(f"Found {len(load_queue)} users to load.")
 
             # Если нет объектов, выходим из процесса.
@@ -94,12 +90,10 @@ class UsersLoader:
                 self.log.info('Quitting.')
                 return
 
-            # Сохраняем объекты в базу dwh.
-            for user in load_queue:
-                self.workflow.insert_user(target, user)
-
-            # Сохраняем прогресс в базу dwh.
-            last_loaded_user = max(load_queue)
+            # Сохраняем объекты и прогресс в базу dwh, отправляя запросы конвейером без ожидания ответов.
+            last_loaded_user = load_queue[-1]
             user_settings = UserSettings(**last_loaded_user.dict())
-            self.settings_repository.save_setting(target, wf_setting.workflow_key, user_settings)
+            with target.pipeline():
+                self.workflow.insert_users(target, load_queue)
+                self.settings_repository.save_setting(target, wf_setting.workflow_key, user_settings)
             self.log.info(f'Load finished on {user_settings}')
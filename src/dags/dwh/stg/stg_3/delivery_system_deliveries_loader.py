@@ -1,98 +1,104 @@
 from datetime import datetime
 from logging import Logger
-from typing import List
+from typing import Iterator, List
 
 import psycopg
-from bson.objectid import ObjectId
 from pydantic import BaseModel, Extra, Field
 from lib.connect import PgConnect, HttpConnect
 from lib.crud import HttpReader, PgSaver
+from lib.etl_config import EtlConfig
 from lib.etl_settings_repository import EtlSettingsRepository
-from lib.utils import CustomSession, json2str
-from requests.adapters import HTTPAdapter, Retry
+from lib.utils import CustomSession, chunked, json2str
 
 
 class DeliveryObj(BaseModel, extra=Extra.allow, json_dumps=json2str):
     delivery_id: str
     delivery_ts: datetime
 
-    def __lt__(self, other: 'DeliveryObj'):
-        return (self.delivery_ts, self.delivery_id) < (other.delivery_ts, other.delivery_id)
-
 
 class DeliverySettings(BaseModel, allow_population_by_field_name=True):
     last_loaded_ts: datetime = Field(alias='delivery_ts')
-    last_loaded_oid: str = Field(alias='delivery_id', default=str(ObjectId('0' * 24)))
+    last_loaded_oid: str = Field(alias='delivery_id', default='000000000000000000000000')
 
 
 class DeliveriesToStgWorkflow(HttpReader, PgSaver):
 
-    def list_deliveries(self, source: CustomSession, delivery_settings: DeliverySettings, limit: int) -> List[DeliveryObj]:
-        # Добавляем повторное подключение, тк возникает ошибка из-за множества запросов при постраничном чтении.
-        retries = Retry(total=5, backoff_factor=0.1)
-        source.mount('https://', HTTPAdapter(max_retries=retries))
-
-        deliveries = []
-        page_size = 50
-        offset = 0
-        while offset < limit:
-
-            batch = super().list(
-                conn=source,
-                model=DeliveryObj,
-                method='/deliveries',
-                params={
-                    'sort_field': 'date',
-                    'sort_direction': 'asc',
-                    'from': delivery_settings.last_loaded_ts.strftime("%Y-%m-%d %H:%M:%S"),
-                    'offset': offset,
-                    'limit': page_size
-                }
-            )
-
-            if not batch:
-                break
-
-            deliveries += batch
-            offset += len(batch)
-        
-        return deliveries[:limit]
-
-
-    def insert_delivery(self, target: psycopg.Connection, delivery: DeliveryObj) -> None:
+    def list_deliveries(self, source: CustomSession, delivery_settings: DeliverySettings, limit: int) -> Iterator[DeliveryObj]:
+        deliveries = super().stream_pages(
+            conn=source,
+            model=DeliveryObj,
+            method='/deliveries',
+            params={
+                'sort_field': 'date',
+                'sort_direction': 'asc',
+                'from': delivery_settings.last_loaded_ts.strftime("%Y-%m-%d %H:%M:%S")
+            },
+            limit=limit
+        )
+        return deliveries
+
+
+    def insert_deliveries(self, target: psycopg.Connection, deliveries: List[DeliveryObj]) -> None:
+        # Загружаем пачку доставок во временную таблицу через COPY.
+        super().copy(
+            conn=target,
+            staging="""
+                CREATE TEMP TABLE IF NOT EXISTS deliverysystem_deliveries_stg(
+                    delivery_id VARCHAR(2048),
+                    delivery_ts TIMESTAMP,
+                    delivery_value TEXT
+                )
+                ON COMMIT DELETE ROWS;
+            """,
+            query="""
+                COPY deliverysystem_deliveries_stg(delivery_id, delivery_ts, delivery_value) FROM STDIN
+            """,
+            rows=((delivery.delivery_id, delivery.delivery_ts, delivery.json()) for delivery in deliveries)
+        )
+
+        # Переносим пачку в stg-слой, одновременно очищая временную таблицу.
         super().insert(
             conn=target,
             query="""
+                WITH staged AS (
+                    DELETE FROM
+                        deliverysystem_deliveries_stg
+                    RETURNING
+                        delivery_id, delivery_ts, delivery_value
+                )
                 INSERT INTO
                     stg.deliverysystem_deliveries(delivery_id, delivery_ts, delivery_value)
-                VALUES
-                    (%(delivery_id)s, %(delivery_ts)s, %(delivery_value)s)
+                SELECT
+                    delivery_id, delivery_ts, delivery_value
+                FROM
+                    staged
                 ON CONFLICT
                     (delivery_id)
-                DO NOTHING
+                DO NOTHING;
             """,
-            params={
-                'delivery_id': delivery.delivery_id,
-                'delivery_ts': delivery.delivery_ts,
-                'delivery_value': delivery.json()
-            }
+            params=None,
+            prepare=True
         )
 
 
 class DeliveriesLoader:
     WF_KEY = 'deliverysystem_deliveries_origin_to_stg_workflow'
     BATCH_LIMIT = 5000
+    FLUSH_SIZE = 1000
 
     def __init__(self, http_origin: HttpConnect, pg_dest: PgConnect, log: Logger) -> None:
         self.http_origin = http_origin
         self.pg_dest = pg_dest
         self.workflow = DeliveriesToStgWorkflow()
         self.settings_repository = EtlSettingsRepository(schema='stg')
+        etl_config = EtlConfig.load()
+        self.batch_limit = etl_config.batch_limit(self.WF_KEY, self.BATCH_LIMIT)
+        self.flush_size = etl_config.flush_size(self.WF_KEY, self.FLUSH_SIZE)
         self.log = log
 
     def run(self, start_date: datetime):
         # Открываем соединения.
-        with self.http_origin.connection() as source, self.pg_dest.connection() as target:
+        with self.http_origin.connection() as source, self.pg_dest.connection(synchronous_commit=False) as target:
 
             # Прочитываем состояние загрузки.
             wf_setting = self.settings_repository.get_setting(target, self.WF_KEY)
@@ -102,21 +108,21 @@ class DeliveriesLoader:
             delivery_settings = DeliverySettings(**wf_setting.workflow_settings)
             self.log.info(f'Starting to load deliveries from last checkpoint: {delivery_settings}')
 
-            # Вычитываем очередную пачку объектов.
-            load_queue = self.workflow.list_deliveries(source, delivery_settings, self.BATCH_LIMIT)
-            self.log.info(f'Found {len(load_queue)} deliveries to load.')
+            # Вычитываем объекты потоком и сохраняем их в базу dwh пачками, пока следующие страницы загружаются из API.
+            processed = 0
+            last_loaded_delivery = None
+            for load_queue in chunked(self.workflow.list_deliveries(source, delivery_settings, self.batch_limit), self.flush_size):
+                self.workflow.insert_deliveries(target, load_queue)
+                processed += len(load_queue)
+                last_loaded_delivery = load_queue[-1]
+            self.log.info(f'Loaded {processed} deliveries.')
 
             # Если нет объектов, выходим из процесса.
-            if not load_queue:
+            if not last_loaded_delivery:
                 self.log.info('Quitting.')
                 return
 
-            # Сохраняем объекты в базу dwh.
-            for delivery in load_queue:
-                self.workflow.insert_delivery(target, delivery)
-
             # Сохраняем прогресс в базу dwh.
-            last_loaded_delivery = max(load_queue)
             delivery_settings = DeliverySettings(**last_loaded_delivery.dict())
             self.settings_repository.save_setting(target, wf_setting.workflow_key, delivery_settings)
             self.log.info(f'Load finished on {delivery_settings}')
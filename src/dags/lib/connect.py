@@ -4,12 +4,25 @@ from typing import Dict, Generator, Union
 from urllib.parse import quote_plus as quote
 
 import psycopg
+from bson.objectid import ObjectId
+from psycopg.adapt import Dumper
+from psycopg_pool import ConnectionPool
 from airflow.hooks.base import BaseHook
 from airflow.models.variable import Variable
 from pymongo.mongo_client import MongoClient
 from lib.utils import CustomSession
 
 
+class ObjectIdDumper(Dumper):
+
+    def dump(self, obj: ObjectId) -> bytes:
+        return obj.binary.hex().encode()
+
+
+# Идентификаторы Mongo передаются в запросы как есть и пишутся в базу строкой из 24 hex-символов.
+psycopg.adapters.register_dumper(ObjectId, ObjectIdDumper)
+
+
 class Connect(ABC):
     
     @abstractmethod
@@ -35,6 +48,7 @@ class MongoConnect(Connect):
         self.auth_db = auth_db
         self.main_db = main_db
         self.cert_path = cert_path
+        self._client = None
 
     def url(self) -> str:
         return 'mongodb://{user}:{pw}@{hosts}/{db}?replicaSet={rs}&authSource={auth_src}'.format(
@@ -46,17 +60,15 @@ class MongoConnect(Connect):
             auth_src=self.auth_db)
 
     def client(self) -> MongoClient:
-        return MongoClient(self.url(), tlsCAFile=self.cert_path)
+        # Клиент создается при первом обращении и переиспользуется: он сам держит пул соединений к репликасету,
+        # поэтому повторные загрузки в процессе не проходят заново обнаружение топологии, TLS и аутентификацию.
+        if self._client is None:
+            self._client = MongoClient(self.url(), tlsCAFile=self.cert_path)
+        return self._client
 
     @contextmanager
     def connection(self) -> Generator[MongoClient, None, None]:
-        conn = self.client()
-        try:
-            yield conn
-        except Exception as e:
-            raise e
-        finally:
-            conn.close()
+        yield self.client()
 
 
 class PgConnect(Connect):
@@ -67,6 +79,7 @@ class PgConnect(Connect):
         self.user = user
         self.pw = pw
         self.sslmode = sslmode
+        self._pool = None
 
     def url(self) -> str:
         return """
@@ -88,17 +101,26 @@ class PgConnect(Connect):
     def client(self) -> psycopg.Connection:
         return psycopg.connect(self.url())
 
+    def pool(self) -> ConnectionPool:
+        # Пул создается при первом обращении, чтобы не открывать соединения при разборе дага.
+        # Загрузчики dds и cdm берут из одного пула сразу два соединения (источник и приемник), поэтому держим их открытыми,
+        # а простаивающие сверх минимума закрываем через 5 минут. Соединения старше получаса пересоздаются в фоне.
+        # Дожидаемся открытия минимума соединений, чтобы первый запрос загрузчика не платил за установку соединения.
+        if self._pool is None:
+            self._pool = ConnectionPool(self.url(), min_size=2, max_size=10, max_idle=300, max_lifetime=1800, num_workers=1, open=True)
+            self._pool.wait()
+        return self._pool
+
     @contextmanager
-    def connection(self) -> Generator[psycopg.Connection, None, None]:
-        conn = self.client()
-        try:
+    def connection(self, synchronous_commit: bool = True) -> Generator[psycopg.Connection, None, None]:
+        # Пул фиксирует транзакцию при успешном выходе и откатывает её при исключении.
+        with self.pool().connection() as conn:
+            # Для повторяемых загрузок можно не ждать сброса WAL на диск при фиксации: при сбое сервера теряется
+            # последняя транзакция целиком вместе с контрольной точкой, и загрузка просто повторится.
+            # SET LOCAL действует только до конца транзакции и не переходит на следующие выдачи соединения из пула.
+            if not synchronous_commit:
+                conn.execute('SET LOCAL synchronous_commit = off')
             yield conn
-            conn.commit()
-        except Exception as e:
-            conn.rollback()
-            raise e
-        finally:
-            conn.close()
 
 
 class HttpConnect(Connect):
@@ -1,8 +1,11 @@
 from abc import ABC, abstractmethod
-from typing import Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+from uuid import uuid4
 
 from psycopg import Connection
-from psycopg.rows import class_row
+from psycopg.rows import class_row, kwargs_row
 from pydantic import BaseModel
 from pydantic.main import ModelMetaclass
 from pymongo.mongo_client import MongoClient
@@ -25,19 +28,40 @@ class Reader(ABC):
 
 class PgSaver(Saver):
 
-    def insert(self, conn: Connection, query: str, params: Dict) -> None:
+    def insert(self, conn: Connection, query: str, params: Dict, prepare: Optional[bool] = None) -> None:
+        # Запросы, повторяемые на каждой пачке, подготавливаются на сервере, чтобы не разбирались и не планировались заново.
         with conn.cursor() as cur:
-            cur.execute(query, params)
+            cur.execute(query, params, prepare=prepare)
+
+    def insert_many(self, conn: Connection, query: str, params_seq: Iterable[Union[Dict, Tuple]]) -> None:
+        with conn.cursor() as cur:
+            cur.executemany(query, params_seq)
+
+    def copy(self, conn: Connection, query: str, rows: Iterable[Tuple], staging: Optional[str] = None) -> None:
+        with conn.cursor() as cur:
+            # Создаем (если нужно) промежуточную таблицу, в которую затем пишет COPY.
+            if staging:
+                cur.execute(staging)
+            with cur.copy(query) as copy:
+                for row in rows:
+                    copy.write_row(row)
 
 
 class PgReader(Reader):
 
     def list(self, conn: Connection, query: str, model: ModelMetaclass, params: Dict = None) -> List[BaseModel]:
-        with conn.cursor(row_factory=class_row(model)) as cur:
+        # Строки из базы уже имеют нужные типы, поэтому модели создаются без валидации.
+        with conn.cursor(row_factory=kwargs_row(model.construct)) as cur:
             cur.execute(query, params)
             objs = cur.fetchall()
         return objs
 
+    def stream(self, conn: Connection, query: str, model: ModelMetaclass, params: Dict = None, size: int = 500) -> Iterator[BaseModel]:
+        with conn.cursor(name=f'stream_{uuid4().hex}', row_factory=kwargs_row(model.construct)) as cur:
+            cur.itersize = size
+            cur.execute(query, params)
+            yield from cur
+
     def retrieve(self, conn: Connection, query: str, model: ModelMetaclass, params: Dict = None) -> Optional[BaseModel]:
         with conn.cursor(row_factory=class_row(model)) as cur:
             cur.execute(query, params)
@@ -53,6 +77,12 @@ class MongoReader(Reader):
         ]
         return docs
 
+    def stream(self, conn: MongoClient, collection: str, model: ModelMetaclass, filter: Dict = None, sort: List = None, limit: int = None, size: int = 1000) -> Iterator[BaseModel]:
+        # Документы из Mongo уже содержат типизированные ObjectId и datetime, поэтому модели создаются без валидации.
+        cursor = conn.get_database().get_collection(collection).find(filter=filter, sort=sort, limit=limit, batch_size=size)
+        for doc in cursor:
+            yield model.construct(**doc)
+
 
 class HttpReader(Reader):
 
@@ -61,3 +91,29 @@ class HttpReader(Reader):
         if not resp.content:
             return []
         return [model(**item) for item in resp.json()]
+
+    def list_pages(self, conn: CustomSession, method: str, model: ModelMetaclass, limit: int, params: Dict = None, offset: int = 0, page_size: int = 50, workers: int = 8) -> List[BaseModel]:
+        return list(self.stream_pages(conn, method, model, limit, params, offset, page_size, workers))
+
+    def stream_pages(self, conn: CustomSession, method: str, model: ModelMetaclass, limit: int, params: Dict = None, offset: int = 0, page_size: int = 50, workers: int = 8) -> Iterator[BaseModel]:
+        # Запрашиваем страницы параллельно волнами по workers штук и останавливаемся на первой неполной странице.
+        # Следующая волна отправляется до того, как вызывающий код обработает текущую, поэтому чтение идет параллельно с записью.
+        page_size = min(page_size, limit)
+
+        def fetch(page_offset: int) -> List[BaseModel]:
+            return self.list(conn, method, model, {**(params or {}), 'offset': page_offset, 'limit': page_size})
+
+        offsets = iter(range(offset, offset + limit, page_size))
+        remaining = limit
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            wave = [executor.submit(fetch, page_offset) for page_offset in islice(offsets, workers)]
+            while wave:
+                pages = [future.result() for future in wave]
+                short = next((i for i, page in enumerate(pages) if len(page) < page_size), None)
+                if short is None:
+                    wave = [executor.submit(fetch, page_offset) for page_offset in islice(offsets, workers)]
+                else:
+                    pages, wave = pages[:short + 1], []
+                for page in pages:
+                    yield from page[:remaining]
+                    remaining -= min(len(page), remaining)
@@ -0,0 +1,21 @@
+from typing import Dict
+
+from airflow.models.variable import Variable
+from pydantic import BaseModel, Field
+
+
+class EtlConfig(BaseModel):
+    batch_limits: Dict[str, int] = Field(default_factory=dict)
+    flush_sizes: Dict[str, int] = Field(default_factory=dict)
+
+    def batch_limit(self, wf_key: str, default: int) -> int:
+        return self.batch_limits.get(wf_key, default)
+
+    def flush_size(self, wf_key: str, default: int) -> int:
+        return self.flush_sizes.get(wf_key, default)
+
+    @staticmethod
+    def load(var_key: str = 'ETL_CONFIG') -> 'EtlConfig':
+        # Размеры пачек переопределяются по ключу процесса, например: {"batch_limits": {"<WF_KEY>": 1000}, "flush_sizes": {"<WF_KEY>": 500}}.
+        params = Variable.get(var_key, default_var={}, deserialize_json=True)
+        return EtlConfig(**params)
@@ -15,30 +15,29 @@ class EtlSetting(BaseModel):
 class EtlSettingsRepository(PgReader, PgSaver):
     def __init__(self, schema: str) -> None:
         self.schema = schema
-
-    def get_setting(self, conn: Connection, wf_key: str) -> EtlSetting:
-        query = (
+        # Схема фиксирована для репозитория, поэтому тексты запросов собираются один раз.
+        self._get_query = (
             """
                 SELECT id, workflow_key, workflow_settings
                 FROM {schema}.srv_wf_settings
                 WHERE workflow_key = %(etl_key)s;
             """
-        ).format(schema=self.schema)
-
-        etl_setting = self.retrieve(conn, query, EtlSetting, {'etl_key': wf_key})
-
-        return etl_setting or EtlSetting(id=0, workflow_key=wf_key)
-
-    def save_setting(self, сonn: Connection, wf_key: str, wf_settings: Any) -> None:
-        query = (
+        ).format(schema=schema)
+        self._save_query = (
             """
                 INSERT INTO {schema}.srv_wf_settings (workflow_key, workflow_settings)
                 VALUES (%(etl_key)s, %(etl_setting)s)
                 ON CONFLICT (workflow_key) DO UPDATE
                 SET workflow_settings = EXCLUDED.workflow_settings;
             """
-        ).format(schema=self.schema)
+        ).format(schema=schema)
+
+    def get_setting(self, conn: Connection, wf_key: str) -> EtlSetting:
+        etl_setting = self.retrieve(conn, self._get_query, EtlSetting, {'etl_key': wf_key})
 
+        return etl_setting or EtlSetting(id=0, workflow_key=wf_key)
+
+    def save_setting(self, сonn: Connection, wf_key: str, wf_settings: Any) -> None:
         wf_settings_json = json2str(wf_settings)
 
-        self.insert(сonn, query, {'etl_key': wf_key, 'etl_setting': wf_settings_json})
+        self.insert(сonn, self._save_query, {'etl_key': wf_key, 'etl_setting': wf_settings_json})
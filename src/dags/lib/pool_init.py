@@ -0,0 +1,19 @@
+from logging import Logger
+
+from airflow.models import Pool
+from airflow.utils.session import create_session
+
+
+class PoolInit:
+    def __init__(self, log: Logger) -> None:
+        self.log = log
+
+    def init(self, name: str, slots: int, description: str) -> None:
+        # Пул создается только при его отсутствии, чтобы не сбрасывать число слотов, заданное администратором.
+        with create_session() as session:
+            if session.query(Pool).filter(Pool.pool == name).first():
+                self.log.info(f'Pool {name} already exists.')
+                return
+
+            session.add(Pool(pool=name, slots=slots, description=description))
+            self.log.info(f'Pool {name} created with {slots} slots.')
@@ -15,21 +15,29 @@ class SchemaDdl:
         if not prev_execution_date:
             prev_execution_date = DateTime.min
 
-        path = Path(path_to_scripts)
-        file_paths = [file for file in path.iterdir() if os.path.getmtime(file) > prev_execution_date.timestamp()]
+        # Один проход по каталогу: scandir возвращает stat вместе с записью каталога.
+        with os.scandir(path_to_scripts) as entries:
+            file_paths = [
+                Path(entry.path) for entry in entries
+                if entry.is_file() and entry.stat().st_mtime > prev_execution_date.timestamp()
+            ]
         self.log.info(prev_execution_date)
         file_paths.sort(key=lambda x: x.name)
 
         self.log.info(f'Found {len(file_paths)} files to apply changes.')
 
-        i = 1
-        for fp in file_paths:
-            self.log.info(f'Iteration {i}. Applying file {fp.name}')
-            script = fp.read_text()
+        # Если скрипты не менялись с прошлого успешного запуска, к базе не подключаемся.
+        if not file_paths:
+            return
 
-            with self._db.connection() as conn:
-                with conn.cursor() as cur:
-                    cur.execute(script)
+        # Все скрипты применяются через одно соединение, но каждый файл фиксируется в своей транзакции.
+        with self._db.connection() as conn:
+            for i, fp in enumerate(file_paths, start=1):
+                self.log.info(f'Iteration {i}. Applying file {fp.name}')
+                script = fp.read_text()
 
-            self.log.info(f'Iteration {i}. File {fp.name} executed successfully.')
-            i += 1
+                with conn.transaction():
+                    with conn.cursor() as cur:
+                        cur.execute(script)
+
+                self.log.info(f'Iteration {i}. File {fp.name} executed successfully.')
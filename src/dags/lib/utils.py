@@ -1,48 +1,47 @@
 import json
 from datetime import datetime, date
-from typing import Any, Dict, Optional
+from itertools import islice
+from typing import Any, Dict, Iterable, Iterator, List, Optional
 from urllib.parse import urljoin
 
 import requests
 from bson.objectid import ObjectId
 from pydantic import BaseModel
+from requests.adapters import HTTPAdapter, Retry
+
+
+# Дата окончания действия актуальной версии записи измерения.
+ACTIVE_TO_INF = datetime(2099, 12, 31)
 
 
 def json2str(obj: Any, *, default: Optional[Any] = None) -> str:
-    return json.dumps(to_dict(obj), default=default, sort_keys=True, ensure_ascii=False)
+    # Нестандартные типы приводятся прямо во время сериализации, без предварительного обхода всего объекта.
+    def encode(value: Any) -> Any:
+        if isinstance(value, datetime):
+            return value.strftime("%Y-%m-%d %H:%M:%S")
+        elif isinstance(value, date):
+            return value.strftime("%Y-%m-%d")
+        elif isinstance(value, ObjectId):
+            return str(value)
+        elif isinstance(value, BaseModel):
+            return value.dict()
+        elif hasattr(value, "__iter__"):
+            return list(value)
+        elif default is not None:
+            return default(value)
+        raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+    return json.dumps(obj, default=encode, sort_keys=True, ensure_ascii=False)
 
 
 def str2json(str: str) -> Dict:
     return json.loads(str)
 
 
-def to_dict(obj, classkey=None):
-    if isinstance(obj, datetime):
-        return obj.strftime("%Y-%m-%d %H:%M:%S")
-    elif isinstance(obj, date):
-        return obj.strftime("%Y-%m-%d")
-    elif isinstance(obj, ObjectId):
-        return str(obj)
-    if isinstance(obj, dict):
-        data = {}
-        for (k, v) in obj.items():
-            data[k] = to_dict(v, classkey)
-        return data
-    elif isinstance(obj, BaseModel):
-        return to_dict(obj.dict())
-    elif hasattr(obj, "_ast"):
-        return to_dict(obj._ast())
-    elif hasattr(obj, "__iter__") and not isinstance(obj, str):
-        return [to_dict(v, classkey) for v in obj]
-    elif hasattr(obj, "__dict__"):
-        data = dict([(key, to_dict(value, classkey))
-                     for key, value in obj.__dict__.items()
-                     if not callable(value) and not key.startswith('_')])
-        if classkey is not None and hasattr(obj, "__class__"):
-            data[classkey] = obj.__class__.__name__
-        return data
-    else:
-        return obj
+def chunked(iterable: Iterable, size: int) -> Iterator[List]:
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
 
 
 class CustomSession(requests.Session):
@@ -50,6 +49,12 @@ class CustomSession(requests.Session):
         super().__init__()
         self.base_url = base_url
         self.headers.update(headers)
+        # Держим keep-alive соединения для всех потоков постраничного чтения и повторяем запросы,
+        # тк при множестве запросов подряд API периодически отвечает ошибкой.
+        retries = Retry(total=5, backoff_factor=0.1, status_forcelist=(429, 500, 502, 503, 504), allowed_methods={'GET'})
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retries)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
 
     def request(self, method: str, url: str, *args, **kwargs):
         joined_url = urljoin(self.base_url, url)
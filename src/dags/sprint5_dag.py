@@ -1,30 +1,51 @@
 import logging
 from datetime import datetime
+from functools import lru_cache
 
 from airflow.decorators import dag, task, task_group
 from airflow.models import DAG
 from airflow.utils.dates import days_ago
 from airflow.utils.trigger_rule import TriggerRule
 from dwh import stg_1, stg_2, stg_3, dds, cdm
+from lib.pool_init import PoolInit
 from lib.schema_init import SchemaDdl
 from lib.connect import ConnectionBuilder, PgConnect, MongoConnect, HttpConnect
 
 
-# Создаём подключения к источникам и DWH.
-dwh_pg_connect = ConnectionBuilder.pg_conn(conn_id='PG_WAREHOUSE_CONNECTION')
-origin_pg_connect = ConnectionBuilder.pg_conn(conn_id='PG_ORIGIN_BONUS_SYSTEM_CONNECTION')
-origin_mongo_connect = ConnectionBuilder.mongo_conn(var_key='MONGO_ORIGIN_ORDER_SYSTEM_PARAMS')
-origin_http_connect = ConnectionBuilder.http_conn(conn_id='HTTP_ORIGIN_DELIVERY_SYSTEM_CONNECTION')
+# Объявляем подключения к источникам и DWH.
+# Параметры подключений читаются из метаданных Airflow при первом обращении внутри задачи, а не при каждом разборе дага,
+# и затем переиспользуются всеми задачами процесса вместе с пулами соединений.
+@lru_cache(maxsize=None)
+def dwh_pg_connect() -> PgConnect:
+    return ConnectionBuilder.pg_conn(conn_id='PG_WAREHOUSE_CONNECTION')
+
+
+@lru_cache(maxsize=None)
+def origin_pg_connect() -> PgConnect:
+    return ConnectionBuilder.pg_conn(conn_id='PG_ORIGIN_BONUS_SYSTEM_CONNECTION')
+
+
+@lru_cache(maxsize=None)
+def origin_mongo_connect() -> MongoConnect:
+    return ConnectionBuilder.mongo_conn(var_key='MONGO_ORIGIN_ORDER_SYSTEM_PARAMS')
+
+
+@lru_cache(maxsize=None)
+def origin_http_connect() -> HttpConnect:
+    return ConnectionBuilder.http_conn(conn_id='HTTP_ORIGIN_DELIVERY_SYSTEM_CONNECTION')
+
+
+# Пул Airflow, которым ограничивается число одновременных сессий в dwh.
+DWH_POOL = 'dwh_write'
+DWH_POOL_SLOTS = 6
 
 # Объявляем словарь с аргументами, которые передаются при запуске задач.
 args = {
-    'dwh_pg_connect': dwh_pg_connect,
-    'origin_pg_connect': origin_pg_connect,
-    'origin_mongo_connect': origin_mongo_connect,
-    'origin_http_connect': origin_http_connect,
     'dags_dir': '/lessons/dags',
     'log': logging.getLogger(__name__),
-    'trigger_rule': TriggerRule.ALL_DONE
+    'trigger_rule': TriggerRule.ALL_DONE,
+    # Все задачи пишут в dwh, поэтому число одновременных сессий ограничивается общим пулом Airflow.
+    'pool': DWH_POOL
 }
 
 # Объявляем DAG с настройками задач по умолчанию.
@@ -40,30 +61,37 @@ args = {
 )
 def settlements_mart_dag():
 
-    # Создаем структуру таблиц DWH.
+    # Создаем пул загрузок и структуру таблиц DWH.
+    # Задачи инициализации выполняются в пуле по умолчанию, тк пул dwh_write может быть еще не создан.
     @task_group(group_id='INIT')
     def init_dwh():
 
-        @task(task_id='stg')
-        def init_stg(dwh_pg_connect: PgConnect, dags_dir: str, log: logging.Logger, prev_start_date_success: datetime = None):
-            stg_schema = SchemaDdl(dwh_pg_connect, log)
+        @task(task_id='pool', pool='default_pool')
+        def init_pool(log: logging.Logger):
+            dwh_pool = PoolInit(log)
+            dwh_pool.init(DWH_POOL, DWH_POOL_SLOTS, 'Параллельные загрузки в DWH')
+
+        @task(task_id='stg', pool='default_pool')
+        def init_stg(dags_dir: str, log: logging.Logger, prev_start_date_success: datetime = None):
+            stg_schema = SchemaDdl(dwh_pg_connect(), log)
             stg_schema.init(dags_dir + '/dwh/stg/ddl', prev_start_date_success)
 
-        @task(task_id='dds')
-        def init_dds(dwh_pg_connect: PgConnect, dags_dir: str, log: logging.Logger, prev_start_date_success: datetime = None):
-            dds_schema = SchemaDdl(dwh_pg_connect, log)
+        @task(task_id='dds', pool='default_pool')
+        def init_dds(dags_dir: str, log: logging.Logger, prev_start_date_success: datetime = None):
+            dds_schema = SchemaDdl(dwh_pg_connect(), log)
             dds_schema.init(dags_dir + '/dwh/dds/ddl', prev_start_date_success)
 
-        @task(task_id='cdm')
-        def init_cdm(dwh_pg_connect: PgConnect, dags_dir: str, log: logging.Logger, prev_start_date_success: datetime = None):
-            cdm_schema = SchemaDdl(dwh_pg_connect, log)
+        @task(task_id='cdm', pool='default_pool')
+        def init_cdm(dags_dir: str, log: logging.Logger, prev_start_date_success: datetime = None):
+            cdm_schema = SchemaDdl(dwh_pg_connect(), log)
             cdm_schema.init(dags_dir + '/dwh/cdm/ddl', prev_start_date_success)
 
+        pool_init = init_pool()
         stg_init = init_stg()
         dds_init = init_dds()
         cdm_init = init_cdm()
 
-        [stg_init, dds_init, cdm_init]
+        [pool_init, stg_init, dds_init, cdm_init]
 
 
     # Заполняем STG-слой данными из подсистемы бонусных расчётов компании.
@@ -71,18 +99,18 @@ def settlements_mart_dag():
     def load_stg_1():
 
         @task(task_id='bonussystem_ranks')
-        def load_bonus_system_ranks(origin_pg_connect: PgConnect, dwh_pg_connect: PgConnect, log: logging.Logger):
-            ranks_to_stg = stg_1.RanksLoader(origin_pg_connect, dwh_pg_connect, log)
+        def load_bonus_system_ranks(log: logging.Logger):
+            ranks_to_stg = stg_1.RanksLoader(origin_pg_connect(), dwh_pg_connect(), log)
             ranks_to_stg.run()
         
         @task(task_id='bonussystem_users')
-        def load_bonus_system_users(origin_pg_connect: PgConnect, dwh_pg_connect: PgConnect, log: logging.Logger):
-            users_to_stg = stg_1.UsersLoader(origin_pg_connect, dwh_pg_connect, log)
+        def load_bonus_system_users(log: logging.Logger):
+            users_to_stg = stg_1.UsersLoader(origin_pg_connect(), dwh_pg_connect(), log)
             users_to_stg.run()
 
         @task(task_id='bonussystem_events')
-        def load_bonus_system_events(origin_pg_connect: PgConnect, dwh_pg_connect: PgConnect, log: logging.Logger, dag: DAG = None):
-            events_to_stg = stg_1.EventsLoader(origin_pg_connect, dwh_pg_connect, log)
+        def load_bonus_system_events(log: logging.Logger, dag: DAG = None):
+            events_to_stg = stg_1.EventsLoader(origin_pg_connect(), dwh_pg_connect(), log)
             events_to_stg.run(dag.start_date)
 
         rank_loader = load_bonus_system_ranks()
@@ -97,18 +125,18 @@ def settlements_mart_dag():
     def load_stg_2():
 
         @task(task_id='ordersystem_restaurants')
-        def load_order_system_restaurants(origin_mongo_connect: MongoConnect, dwh_pg_connect: PgConnect, log: logging.Logger):
-            restaurants_to_stg = stg_2.RestaurantsLoader(origin_mongo_connect, dwh_pg_connect, log)
+        def load_order_system_restaurants(log: logging.Logger):
+            restaurants_to_stg = stg_2.RestaurantsLoader(origin_mongo_connect(), dwh_pg_connect(), log)
             restaurants_to_stg.run()
 
         @task(task_id='ordersystem_orders')
-        def load_order_system_orders(origin_mongo_connect: MongoConnect, dwh_pg_connect: PgConnect, log: logging.Logger, dag: DAG = None):
-            orders_to_stg = stg_2.OrdersLoader(origin_mongo_connect, dwh_pg_connect, log)
+        def load_order_system_orders(log: logging.Logger, dag: DAG = None):
+            orders_to_stg = stg_2.OrdersLoader(origin_mongo_connect(), dwh_pg_connect(), log)
             orders_to_stg.run(dag.start_date)
 
         @task(task_id='ordersystem_users')
-        def load_order_system_users(origin_mongo_connect: MongoConnect, dwh_pg_connect: PgConnect, log: logging.Logger):
-            users_to_stg = stg_2.UsersLoader(origin_mongo_connect, dwh_pg_connect, log)
+        def load_order_system_users(log: logging.Logger):
+            users_to_stg = stg_2.UsersLoader(origin_mongo_connect(), dwh_pg_connect(), log)
             users_to_stg.run()
 
         restaurant_loader = load_order_system_restaurants()
@@ -123,18 +151,18 @@ def settlements_mart_dag():
     def load_stg_3():
 
         @task(task_id='deliverysystem_restaurants')
-        def load_delivery_system_restaurants(origin_http_connect: HttpConnect, dwh_pg_connect: PgConnect, log: logging.Logger):
-            restaurants_to_stg = stg_3.RestaurantsLoader(origin_http_connect, dwh_pg_connect, log)
+        def load_delivery_system_restaurants(log: logging.Logger):
+            restaurants_to_stg = stg_3.RestaurantsLoader(origin_http_connect(), dwh_pg_connect(), log)
             restaurants_to_stg.run()
 
         @task(task_id='deliverysystem_couriers')
-        def load_delivery_system_couriers(origin_http_connect: HttpConnect, dwh_pg_connect: PgConnect, log: logging.Logger):
-            couriers_to_stg = stg_3.CouriersLoader(origin_http_connect, dwh_pg_connect, log)
+        def load_delivery_system_couriers(log: logging.Logger):
+            couriers_to_stg = stg_3.CouriersLoader(origin_http_connect(), dwh_pg_connect(), log)
             couriers_to_stg.run()
 
         @task(task_id='deliverysystem_deliveries')
-        def load_delivery_system_deliveries(origin_http_connect: HttpConnect, dwh_pg_connect: PgConnect, log: logging.Logger, dag: DAG = None):
-            deliveries_to_stg = stg_3.DeliveriesLoader(origin_http_connect, dwh_pg_connect, log)
+        def load_delivery_system_deliveries(log: logging.Logger, dag: DAG = None):
+            deliveries_to_stg = stg_3.DeliveriesLoader(origin_http_connect(), dwh_pg_connect(), log)
             deliveries_to_stg.run(dag.start_date)
 
         restaurant_loader = load_delivery_system_restaurants()
@@ -145,47 +173,48 @@ def settlements_mart_dag():
 
 
     # Переносим данные из STG-слоя в DDS-слой.
+    # Независимые загрузчики выполняются параллельно в пределах пула dwh_write.
     @task_group(group_id='DDS')
     def load_dds():
 
         @task(task_id='dm_users')
-        def load_dimension_users(dwh_pg_connect: PgConnect, log: logging.Logger):
-            users_to_dds = dds.UsersLoader(dwh_pg_connect, dwh_pg_connect, log)
+        def load_dimension_users(log: logging.Logger):
+            users_to_dds = dds.UsersLoader(dwh_pg_connect(), dwh_pg_connect(), log)
             users_to_dds.run()
 
         @task(task_id='dm_restaurants')
-        def load_dimension_restaurants(dwh_pg_connect: PgConnect, log: logging.Logger):
-            restaurants_to_dds = dds.RestaurantsLoader(dwh_pg_connect, dwh_pg_connect, log)
+        def load_dimension_restaurants(log: logging.Logger):
+            restaurants_to_dds = dds.RestaurantsLoader(dwh_pg_connect(), dwh_pg_connect(), log)
             restaurants_to_dds.run()
 
         @task(task_id='dm_timestamps')
-        def load_dimension_timestamps(dwh_pg_connect: PgConnect, log: logging.Logger):
-            timestamps_to_dds = dds.TimestampsLoader(dwh_pg_connect, dwh_pg_connect, log)
+        def load_dimension_timestamps(log: logging.Logger):
+            timestamps_to_dds = dds.TimestampsLoader(dwh_pg_connect(), dwh_pg_connect(), log)
             timestamps_to_dds.run()
 
         @task(task_id='dm_couriers')
-        def load_dimension_couriers(dwh_pg_connect: PgConnect, log: logging.Logger):
-            couriers_to_dds = dds.CouriersLoader(dwh_pg_connect, dwh_pg_connect, log)
+        def load_dimension_couriers(log: logging.Logger):
+            couriers_to_dds = dds.CouriersLoader(dwh_pg_connect(), dwh_pg_connect(), log)
             couriers_to_dds.run()
 
         @task(task_id='dm_products')
-        def load_dimension_products(dwh_pg_connect: PgConnect, log: logging.Logger):
-            products_to_dds = dds.ProductsLoader(dwh_pg_connect, dwh_pg_connect, log)
+        def load_dimension_products(log: logging.Logger):
+            products_to_dds = dds.ProductsLoader(dwh_pg_connect(), dwh_pg_connect(), log)
             products_to_dds.run()
 
         @task(task_id='dm_orders')
-        def load_dimension_orders(dwh_pg_connect: PgConnect, log: logging.Logger):
-            orders_to_dds = dds.OrdersLoader(dwh_pg_connect, dwh_pg_connect, log)
+        def load_dimension_orders(log: logging.Logger):
+            orders_to_dds = dds.OrdersLoader(dwh_pg_connect(), dwh_pg_connect(), log)
             orders_to_dds.run()
 
         @task(task_id='fct_product_sales')
-        def load_facts_product_sales(dwh_pg_connect: PgConnect, log: logging.Logger):
-            product_sales_to_dds = dds.ProductSalesLoader(dwh_pg_connect, dwh_pg_connect, log)
+        def load_facts_product_sales(log: logging.Logger):
+            product_sales_to_dds = dds.ProductSalesLoader(dwh_pg_connect(), dwh_pg_connect(), log)
             product_sales_to_dds.run()
 
         @task(task_id='fct_deliveries')
-        def load_facts_deliveries(dwh_pg_connect: PgConnect, log: logging.Logger):
-            deliveries_to_dds = dds.DeliveriesLoader(dwh_pg_connect, dwh_pg_connect, log)
+        def load_facts_deliveries(log: logging.Logger):
+            deliveries_to_dds = dds.DeliveriesLoader(dwh_pg_connect(), dwh_pg_connect(), log)
             deliveries_to_dds.run()
 
         user_loader = load_dimension_users()
@@ -204,17 +233,18 @@ def settlements_mart_dag():
 
 
     # Заполняем витрины в слое CDM.
+    # Загрузчик витрины пересчитывает периоды в нескольких сессиях dwh, поэтому задача занимает слот пула на каждую из них.
     @task_group(group_id='CDM')
     def load_cdm():
 
-        @task(task_id='dm_settlement_report')
-        def load_datamart_settlement_report(dwh_pg_connect: PgConnect, log: logging.Logger):
-            settlement_report_to_cdm = cdm.SettlementReportLoader(dwh_pg_connect, dwh_pg_connect, log)
+        @task(task_id='dm_settlement_report', pool_slots=cdm.SettlementReportLoader.MAX_WORKERS)
+        def load_datamart_settlement_report(log: logging.Logger):
+            settlement_report_to_cdm = cdm.SettlementReportLoader(dwh_pg_connect(), log)
             settlement_report_to_cdm.run()
 
-        @task(task_id='dm_courier_ledger')
-        def load_datamart_courier_ledger(dwh_pg_connect: PgConnect, log: logging.Logger):
-            courier_ledger_to_cdm = cdm.CourierLedgerLoader(dwh_pg_connect, dwh_pg_connect, log)
+        @task(task_id='dm_courier_ledger', pool_slots=cdm.CourierLedgerLoader.MAX_WORKERS)
+        def load_datamart_courier_ledger(log: logging.Logger):
+            courier_ledger_to_cdm = cdm.CourierLedgerLoader(dwh_pg_connect(), log)
             courier_ledger_to_cdm.run()
 
         settlement_report_loader = load_datamart_settlement_report()
@@ -0,0 +1,14 @@
+import pytest
+import requests
+
+
+@pytest.fixture(scope='session')
+def checker_session():
+    # Все проверки отправляются через одну сессию, чтобы переиспользовать keep-alive соединение с сервером тестов.
+    with requests.Session() as session:
+        yield session
+
+
+@pytest.fixture(scope='class', autouse=True)
+def bind_checker_session(request, checker_session):
+    request.cls.session = checker_session
@@ -1,9 +1,8 @@
 import unittest
-import requests
 
 
-def submit(t_code):
-    r = requests.post(
+def submit(session, t_code):
+    r = session.post(
         'http://localhost:3002',
         json={
             "code": "SELECT",
@@ -12,7 +11,8 @@ def submit(t_code):
         timeout=5)
 
 
-    stderr, stdout = r.json()['stderr'], r.json()['stdout']
+    data = r.json()
+    stderr, stdout = data['stderr'], data['stdout']
 
     print(stderr)
     print(stdout)
@@ -24,23 +24,23 @@ class TestCdmSchemaInit(unittest.TestCase):
     """Проектирование слоя CDM."""
 
     def test_ddl_dm_settlement_report(self):
-        self.assertIn('xjnEv7JXWN', submit('de05030601'))
+        self.assertIn('xjnEv7JXWN', submit(self.session, 'de05030601'))
 
     def test_constaints_dm_settlement_report_pkey(self):
-        self.assertIn('5zF17A2Gzb', submit('de05030602'))
+        self.assertIn('5zF17A2Gzb', submit(self.session, 'de05030602'))
     
     def test_constaints_dm_settlement_report_settlement_date_check(self):
-        self.assertIn('ZBfLxNLryk', submit('de05030603'))
+        self.assertIn('ZBfLxNLryk', submit(self.session, 'de05030603'))
 
     def test_constaints_dm_settlement_metrics_check(self):
-        self.assertIn('qUpu6QoZs9', submit('de05030604'))
+        self.assertIn('qUpu6QoZs9', submit(self.session, 'de05030604'))
 
     def test_constaints_dm_settlement_report_settlement_date_restaurant_id_unique(self):
-        self.assertIn('YLalElZtMP', submit('de05030605'))
+        self.assertIn('YLalElZtMP', submit(self.session, 'de05030605'))
 
 
 class TestDdsOriginToCdm(unittest.TestCase):
     """Перенос данных из DDS в CDM."""
 
     def test_load_dm_settlement_report(self):
-        self.assertIn('QAJuAX0xGs', submit('de05040801'))
+        self.assertIn('QAJuAX0xGs', submit(self.session, 'de05040801'))
@@ -1,9 +1,8 @@
 import unittest
-import requests
 
 
-def submit(t_code):
-    r = requests.post(
+def submit(session, t_code):
+    r = session.post(
         'http://localhost:3002',
         json={
             "code": "SELECT",
@@ -11,7 +10,8 @@ def submit(t_code):
             },
         timeout=10)
 
-    stderr, stdout = r.json()['stderr'], r.json()['stdout']
+    data = r.json()
+    stderr, stdout = data['stderr'], data['stdout']
 
     print(stderr)
     print(stdout)
@@ -23,56 +23,56 @@ class TestDdsSchemaInit(unittest.TestCase):
     """Проектирование слоя DDS."""
 
     def test_ddl_dds_schema(self):
-        self.assertIn('7lcOGpj4ZL', submit('de05030801'))
+        self.assertIn('7lcOGpj4ZL', submit(self.session, 'de05030801'))
 
     def test_ddl_dm_users(self):
-        self.assertIn('g0MSs4ez0v', submit('de05030802'))
+        self.assertIn('g0MSs4ez0v', submit(self.session, 'de05030802'))
     
     def test_ddl_dm_restaurants(self):
-        self.assertIn('h5xVUDD1Wm', submit('de05030803'))
+        self.assertIn('h5xVUDD1Wm', submit(self.session, 'de05030803'))
 
     def test_ddl_dm_products(self):
-        self.assertIn('yCYrkJMm2Z', submit('de05030804'))
+        self.assertIn('yCYrkJMm2Z', submit(self.session, 'de05030804'))
 
     def test_constraints_dm_products_restaurant_id_fkey(self):
-        self.assertIn('rgNx3z8aKm', submit('de05030805'))
+        self.assertIn('rgNx3z8aKm', submit(self.session, 'de05030805'))
 
     def test_ddl_dm_timestamps(self):
-        self.assertIn('tIVtQGEgoL', submit('de05030806'))
+        self.assertIn('tIVtQGEgoL', submit(self.session, 'de05030806'))
 
     def test_ddl_dm_orders(self):
-        self.assertIn('wgfELwIQ0E', submit('de05030807'))
+        self.assertIn('wgfELwIQ0E', submit(self.session, 'de05030807'))
 
     def test_constraints_dm_orders_fkeys(self):
-        self.assertIn('FyKdrGMogs', submit('de05030808'))
+        self.assertIn('FyKdrGMogs', submit(self.session, 'de05030808'))
 
     def test_ddl_fct_product_sales(self):
-        self.assertIn('udZMKdxadM', submit('de05030809'))
+        self.assertIn('udZMKdxadM', submit(self.session, 'de05030809'))
 
     def test_constraints_fct_product_sales_fkeys(self):
-        self.assertIn('NVyO1i2Dr5', submit('de05030810'))
+        self.assertIn('NVyO1i2Dr5', submit(self.session, 'de05030810'))
 
 
 class TestStgOriginToDds(unittest.TestCase):
     """Перенос данных из STG в DDS."""
 
     def test_ddl_srv_wf_settings(self):
-        self.assertIn('RqgcX9kTN6', submit('de05040701'))
+        self.assertIn('RqgcX9kTN6', submit(self.session, 'de05040701'))
     
     def test_load_dm_users(self):
-        self.assertIn('kX3riKpibW', submit('de05040702'))
+        self.assertIn('kX3riKpibW', submit(self.session, 'de05040702'))
 
     def test_load_dm_restaurants(self):
-        self.assertIn('mgXgcqQzFv', submit('de05040703'))
+        self.assertIn('mgXgcqQzFv', submit(self.session, 'de05040703'))
 
     def test_load_dm_timestamps(self):
-        self.assertIn('WXcbW1NLh9', submit('de05040704'))
+        self.assertIn('WXcbW1NLh9', submit(self.session, 'de05040704'))
 
     def test_load_dm_products(self):
-        self.assertIn('y7M8bxX1z9', submit('de05040705'))
+        self.assertIn('y7M8bxX1z9', submit(self.session, 'de05040705'))
 
     def test_load_dm_orders(self):
-        self.assertIn('8i8NjzMWsa', submit('de05040706'))
+        self.assertIn('8i8NjzMWsa', submit(self.session, 'de05040706'))
 
     def test_load_fct_product_sales(self):
-        self.assertIn('jemju9gmX7', submit('de05040707'))
+        self.assertIn('jemju9gmX7', submit(self.session, 'de05040707'))